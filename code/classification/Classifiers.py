@@ -1,10 +1,16 @@
 import pandas as pd
 import numpy as np
+from joblib import Parallel, delayed
+from scipy import sparse
+from sklearn.base import clone
 from sklearn.model_selection import train_test_split
 from sklearn.feature_selection import chi2, mutual_info_classif
 from sklearn.model_selection import GridSearchCV, KFold, cross_validate
-from sklearn.metrics import classification_report, roc_auc_score, confusion_matrix
-from sklearn.preprocessing import StandardScaler, MinMaxScaler, RobustScaler
+from sklearn.metrics import classification_report, roc_auc_score, confusion_matrix, accuracy_score, precision_score, \
+    recall_score, f1_score
+from sklearn.preprocessing import StandardScaler, MinMaxScaler, MaxAbsScaler, RobustScaler
+
+from .CompiledEnsemble import CompiledEnsemble
 
 """
 Example of the classifier input:
@@ -30,12 +36,33 @@ metrics = ['accuracy', 'precision', 'f1', 'roc_auc', 'recall']
 classnames = ['no-clickbait', 'clickbait']
 
 
+def _fit_predict_proba(clf, data, labels, train, test):
+    """Fits a classifier on one fold and returns the clickbait probabilities of the held-out rows."""
+
+    clf.fit(data[train], labels[train])
+    return clf.predict_proba(data[test])[:, 1]
+
+
 class Classifiers:
-    def __init__(self, feature_df: pd.DataFrame, labels, classifiers):
+    def __init__(self, feature_df: pd.DataFrame, labels, classifiers, sparse_features=None):
+        """
+        :param feature_df: Dense (handcrafted) features.
+        :param labels: Target labels.
+        :param classifiers: Classifier settings (see example above).
+        :param sparse_features: Optional sparse matrix (e.g. hashed n-grams) that is appended to the dense features.
+        """
+
         self.df = feature_df
         # Extract the dataframe as a numpy array
         self.data = feature_df.to_numpy()
         self.labels = labels
+        self.feature_names = list(feature_df.columns)
+        self.num_dense = len(self.feature_names)
+
+        # Stack dense and sparse features column-wise in a single CSR matrix
+        if sparse_features is not None:
+            self.data = sparse.hstack([sparse.csr_matrix(self.data, dtype=np.float64), sparse_features], format='csr')
+            self.feature_names += ['ngram_{}'.format(i) for i in range(sparse_features.shape[1])]
 
         self.classifiers = classifiers
 
@@ -48,15 +75,30 @@ class Classifiers:
             labels = self.labels
 
         # Use info gain for classification as we have a binary classification problem
-        info = mutual_info_classif(data, labels, discrete_features=False)
+        if sparse.issparse(data):
+            # Sparse data can only have discrete features: score the dense block as continuous
+            # and the (discrete) n-gram counts separately
+            data = sparse.csc_matrix(data)
+            ngrams = data[:, self.num_dense:]
+
+            # Most hashed columns are empty (and have no information gain): only score the used ones
+            used = ngrams.getnnz(axis=0) > 0
+            ngram_info = np.zeros(ngrams.shape[1])
+            if used.any():
+                ngram_info[used] = mutual_info_classif(ngrams[:, used], labels, discrete_features=True)
+
+            info = np.concatenate([
+                mutual_info_classif(data[:, :self.num_dense].toarray(), labels, discrete_features=False), ngram_info])
+        else:
+            info = mutual_info_classif(data, labels, discrete_features=False)
 
         # Create data frame with feature names and sort ascending
-        combined = list(zip(self.df.columns, info))
+        combined = list(zip(self.feature_names, info))
         combined = pd.DataFrame(combined, columns=['Feature Name', 'Info Gain'])
 
         # Sort ascending and reindex
         combined = combined.sort_values(by=['Info Gain'], ascending=False)
-        combined.index = range(1, len(self.df.columns) + 1)
+        combined.index = range(1, len(combined) + 1)
 
         # print("Information gain of whole dataset")
         # print(combined)
@@ -75,7 +117,7 @@ class Classifiers:
         result_df['Mean'] = result_df.mean(axis=1)
 
         result_df = result_df.sort_values(by=['Mean'], ascending=False)
-        result_df.index = range(1, len(self.df.columns) + 1)
+        result_df.index = range(1, len(result_df) + 1)
 
         return result_df
 
@@ -97,21 +139,23 @@ class Classifiers:
     def standard_scaling(self):
         # Scale features to N(0,1) -> xi - mean(x) / std(x)
         # THIS ASSUME THAT THE DATA IS NORMAL DISTRIBUTED!!
-        scaler = StandardScaler()
+        # Centering would densify sparse data, so only scale in that case
+        scaler = StandardScaler(with_mean=not sparse.issparse(self.data))
         scaled_features = scaler.fit_transform(self.data, self.labels)
 
         return scaled_features
 
     def minmax_scaling(self):
         # Scale features to predetermined range (0-1) -> xi - min(x) / max(x) - min(x)
-        scaler = MinMaxScaler()
+        # Shifting by the minimum would densify sparse data, so scale by the maximum absolute value in that case
+        scaler = MaxAbsScaler() if sparse.issparse(self.data) else MinMaxScaler()
         scaled_features = scaler.fit_transform(self.data, self.labels)
 
         return scaled_features
 
     def robust_scaling(self):
         # Scale just like minmax but more robust against outliers
-        scaler = RobustScaler()
+        scaler = RobustScaler(with_centering=not sparse.issparse(self.data))
         scaled_features = scaler.fit_transform(self.data, self.labels)
 
         return scaled_features
@@ -199,6 +243,138 @@ class Classifiers:
 
         print("-- Finished cross validation --")
 
+    def evaluate(self, n_splits=10, threshold=0.5, n_jobs=-2):
+        """
+        Evaluates all classifiers from a single set of out-of-fold predictions.
+
+        The folds are computed once and shared by all classifiers; every (classifier, fold) fit runs
+        in parallel. The out-of-fold probabilities are stored in the classifier settings ('oof_proba'),
+        so metrics at other thresholds and threshold curves can be derived without refitting.
+        """
+
+        print("-- Out-of-fold evaluation with {}-folds --".format(n_splits))
+
+        labels = np.asarray(self.labels)
+        self.folds = list(KFold(n_splits=n_splits, shuffle=True).split(self.data))
+
+        # Get optimized classifiers, skip the ones that are not available
+        selected = []
+        for _, val in enumerate(self.classifiers):
+            optimized = self._get_optimized_clf(val)
+
+            if optimized is None:
+                continue
+
+            selected.append((val, optimized[0]))
+
+        jobs = [(val, clf, train, test) for val, clf in selected for train, test in self.folds]
+        probas = Parallel(n_jobs=n_jobs)(
+            delayed(_fit_predict_proba)(clone(clf), self.data, labels, train, test) for _, clf, train, test in jobs)
+
+        # Collect the out-of-fold probabilities per classifier
+        for val, _ in selected:
+            val['oof_proba'] = np.empty(len(labels))
+
+        for (val, _, _, test), proba in zip(jobs, probas):
+            val['oof_proba'][test] = proba
+
+        results = dict()
+        for val, _ in selected:
+            name = val['name']
+            results[name] = self.oof_scores(val, threshold)
+
+            print("Out-of-fold performance {}:".format(name))
+            print(pd.Series(results[name]).to_string())
+            print("Confusion matrix:")
+            print(self.oof_confusion_matrix(val, threshold))
+            print("\n")
+
+        print("-- Finished out-of-fold evaluation --")
+
+        return pd.DataFrame(results).T
+
+    def oof_scores(self, val, threshold=0.5):
+        """Computes the evaluation metrics from the cached out-of-fold probabilities of a classifier."""
+
+        labels = np.asarray(self.labels)
+        proba = val['oof_proba']
+        preds = (proba >= threshold).astype(int)
+
+        scores = dict()
+        scores['accuracy'] = accuracy_score(labels, preds)
+        scores['precision'] = precision_score(labels, preds, zero_division=0)
+        scores['recall'] = recall_score(labels, preds, zero_division=0)
+        scores['f1'] = f1_score(labels, preds, zero_division=0)
+        scores['roc_auc'] = roc_auc_score(labels, proba)
+
+        return scores
+
+    def oof_confusion_matrix(self, val, threshold=0.5):
+        preds = (val['oof_proba'] >= threshold).astype(int)
+        return confusion_matrix(y_true=self.labels, y_pred=preds, labels=[0, 1])
+
+    def threshold_curves(self, val) -> pd.DataFrame:
+        """
+        Returns precision, recall, F1, FPR and TPR of a classifier for every distinct threshold
+        on its out-of-fold probabilities (computed in one sorted pass).
+        """
+
+        labels = np.asarray(self.labels)
+        proba = val['oof_proba']
+
+        # Sort descending: predicting positive for the first k rows = threshold at the k-th probability
+        order = np.argsort(-proba, kind='mergesort')
+        proba = proba[order]
+        labels = labels[order]
+
+        tp = np.cumsum(labels == 1)
+        fp = np.cumsum(labels != 1)
+
+        # Only keep the last row of every distinct threshold
+        last = np.r_[np.diff(proba) != 0, True]
+        tp, fp, thresholds = tp[last], fp[last], proba[last]
+
+        num_pos = max(tp[-1], 1)
+        num_neg = max(fp[-1], 1)
+
+        precision = tp / (tp + fp)
+        recall = tp / num_pos
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+
+        return pd.DataFrame({'threshold': thresholds, 'precision': precision, 'recall': recall, 'f1': f1,
+                             'fpr': fp / num_neg, 'tpr': recall})
+
+    def compile(self, val, path=None, check=True, check_rows=1000):
+        """
+        Fits a tree ensemble classifier on all data and compiles it to a CompiledEnsemble for fast batch prediction.
+        Optionally checks prediction parity on a sample of check_rows training rows and saves the compiled model to path.
+        """
+
+        optimized = self._get_optimized_clf(val)
+        if optimized is None:
+            return None
+
+        clf, name = optimized
+
+        # Reject unsupported models before the (expensive) fit
+        CompiledEnsemble.check_compilable(clf)
+        clf.fit(self.data, self.labels)
+
+        compiled = CompiledEnsemble.compile(clf)
+
+        if check:
+            diff = compiled.check_parity(clf, self.data, sample=check_rows)
+            print("Compiled {}: {} trees, {} nodes (max. difference {})".format(name, compiled.n_trees,
+                                                                             compiled.n_nodes, diff))
+
+        if path is not None:
+            compiled.save(path)
+
+        val['compiled_model'] = compiled
+
+        return compiled
+
     def __split_cv_results(self, results):
         train = dict()
         test = dict()
@@ -0,0 +1,376 @@
+import json
+
+import numpy as np
+from scipy import sparse
+
+"""
+Array-based representation of fitted tree ensembles for fast batch prediction.
+
+All trees are stored in flat node arrays (feature, threshold, left / right / missing child, leaf value).
+Leaf values are scaled at compile time, so every supported ensemble predicts as
+    link(base + sum of the leaf values reached in each tree)
+with link = identity (RandomForest: mean of leaf probabilities) or sigmoid (AdaBoost, XGBoost).
+
+Supported models: sklearn RandomForestClassifier / ExtraTreesClassifier, AdaBoostClassifier over
+decision trees (SAMME and SAMME.R) and binary:logistic XGBClassifier / Booster.
+
+Example:
+compiled = CompiledEnsemble.compile(fitted_model)
+compiled.check_parity(fitted_model, features)
+compiled.save('model.npz')
+proba = CompiledEnsemble.load('model.npz').predict_proba(features)
+"""
+
+
+class CompiledEnsemble:
+    def __init__(self, feature, threshold, left, right, missing, value, roots, max_depth, base=0.0, link='identity',
+                 strict=False):
+        """
+        :param feature: Feature index per node (0 for leaves).
+        :param threshold: Split threshold per node.
+        :param left: Child for values below the threshold; leaves point to themselves.
+        :param right: Child for values above the threshold; leaves point to themselves.
+        :param missing: Child for missing (NaN) values.
+        :param value: Scaled leaf value per node (0 for internal nodes).
+        :param roots: Index of the root node of every tree.
+        :param max_depth: Maximum depth over all trees.
+        :param base: Constant added to the summed leaf values.
+        :param link: 'identity' or 'sigmoid'.
+        :param strict: Split rule is x < threshold (XGBoost) instead of x <= threshold (sklearn).
+        """
+
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.missing = np.asarray(missing, dtype=np.int32)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.max_depth = int(max_depth)
+        self.base = float(base)
+        self.link = str(link)
+        self.strict = bool(strict)
+
+        # Left and right child interleaved, so a step down is a single lookup at 2 * node + go_right
+        self.children = np.column_stack([self.left, self.right]).ravel()
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    def predict_proba(self, data) -> np.ndarray:
+        """Returns the clickbait probability for every row of a dense 2D array."""
+
+        margin = self.decision_function(data)
+
+        if self.link == 'sigmoid':
+            return 1.0 / (1.0 + np.exp(-margin))
+
+        return margin
+
+    def predict(self, data, threshold=0.5) -> np.ndarray:
+        return (self.predict_proba(data) >= threshold).astype(int)
+
+    def decision_function(self, data) -> np.ndarray:
+        # sklearn and XGBoost both compare float32 features against float32 thresholds
+        data = np.asarray(data, dtype=np.float32).astype(np.float64)
+
+        if data.ndim == 1:
+            data = data[np.newaxis, :]
+
+        n_rows, n_cols = data.shape
+        flat = data.ravel()
+        offsets = (np.arange(n_rows) * n_cols)[:, np.newaxis]
+        has_missing = np.isnan(flat).any()
+
+        # Walk all (row, tree) pairs down one level at a time; leaves loop onto themselves
+        nodes = np.repeat(self.roots[np.newaxis, :], n_rows, axis=0)
+        for _ in range(self.max_depth):
+            x = np.take(flat, offsets + np.take(self.feature, nodes))
+            threshold = np.take(self.threshold, nodes)
+            go_right = x >= threshold if self.strict else x > threshold
+
+            next_nodes = np.take(self.children, 2 * nodes + go_right)
+            if has_missing:
+                next_nodes = np.where(np.isnan(x), np.take(self.missing, nodes), next_nodes)
+
+            nodes = next_nodes
+
+        return self.base + np.take(self.value, nodes).sum(axis=1)
+
+    def check_parity(self, model, data, atol=1e-6, sample=None, seed=0):
+        """
+        Compares the compiled predictions with the original model's predict_proba.
+        Raises a ValueError if any probability differs more than atol and returns the maximum difference otherwise.
+
+        :param sample: Only compare a random sample of this many rows.
+        Sparse data is never densified as a whole: only the columns the trees split on are.
+        """
+
+        if sample is not None and data.shape[0] > sample:
+            rows = np.sort(np.random.RandomState(seed).choice(data.shape[0], sample, replace=False))
+            data = data[rows]
+
+        if sparse.issparse(data):
+            data = sparse.csr_matrix(data, dtype=np.float64)
+            expected = model.predict_proba(data)[:, 1]
+
+            columns = self.split_features
+            compiled = self.__select(columns)
+            selected = data[:, columns]
+
+            actual = []
+            for start in range(0, selected.shape[0], 256):
+                # XGBoost treats the values that are not stored in a sparse matrix as missing
+                block = selected[start:start + 256].tocoo()
+                dense = np.full(block.shape, np.nan if self.strict else 0.0)
+                dense[block.row, block.col] = block.data
+
+                actual.append(compiled.predict_proba(dense))
+
+            actual = np.concatenate(actual) if actual else np.zeros(0)
+        else:
+            data = np.asarray(data, dtype=np.float64)
+            expected = model.predict_proba(data)[:, 1]
+            actual = self.predict_proba(data)
+
+        diff = np.max(np.abs(actual - expected)) if len(expected) else 0.0
+
+        if diff > atol:
+            raise ValueError("Compiled ensemble does not match the original model (max. difference {}).".format(diff))
+
+        return diff
+
+    @property
+    def split_features(self):
+        """Sorted indices of the features used in at least one split."""
+
+        internal = self.left != np.arange(self.n_nodes)
+        return np.unique(self.feature[internal])
+
+    def __select(self, columns):
+        """Returns a copy that predicts on data[:, columns] instead of data (columns must hold all split features)."""
+
+        internal = self.left != np.arange(self.n_nodes)
+        feature = np.where(internal, np.searchsorted(columns, self.feature), 0)
+
+        return CompiledEnsemble(feature, self.threshold, self.left, self.right, self.missing, self.value, self.roots,
+                                self.max_depth, self.base, self.link, self.strict)
+
+    def save(self, path):
+        np.savez_compressed(path, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+                            missing=self.missing, value=self.value, roots=self.roots,
+                            meta=np.array(json.dumps({'max_depth': self.max_depth, 'base': self.base,
+                                                      'link': self.link, 'strict': self.strict})))
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            return CompiledEnsemble(arrays['feature'], arrays['threshold'], arrays['left'], arrays['right'],
+                                    arrays['missing'], arrays['value'], arrays['roots'], **meta)
+
+    @staticmethod
+    def compile(model):
+        """Compiles a fitted RandomForest, AdaBoost (over decision trees) or XGBoost model."""
+
+        module = type(model).__module__
+        name = type(model).__name__
+
+        if module.startswith('xgboost'):
+            return CompiledEnsemble.from_xgboost(model)
+
+        if name == 'AdaBoostClassifier':
+            return CompiledEnsemble.from_adaboost(model)
+
+        if hasattr(model, 'estimators_') and all(hasattr(e, 'tree_') for e in model.estimators_):
+            return CompiledEnsemble.from_forest(model)
+
+        raise ValueError("Can not compile model of type {}.".format(name))
+
+    @staticmethod
+    def check_compilable(model):
+        """
+        Raises a ValueError if compile() does not support the type of the model.
+        Only needs the model settings, so an unsupported model can be rejected before it is fitted.
+        """
+
+        from sklearn.ensemble import AdaBoostClassifier, ExtraTreesClassifier, RandomForestClassifier
+        from sklearn.tree import DecisionTreeClassifier
+
+        name = type(model).__name__
+
+        if type(model).__module__.startswith('xgboost'):
+            objective = model.get_params().get('objective') if hasattr(model, 'get_params') else None
+
+            if objective not in (None, 'binary:logistic'):
+                raise ValueError("Only binary:logistic XGBoost models are supported (got {}).".format(objective))
+
+            return
+
+        # Decision stumps by default
+        if isinstance(model, AdaBoostClassifier) and getattr(model, 'estimator', None) is None:
+            return
+
+        if isinstance(model, (RandomForestClassifier, ExtraTreesClassifier, AdaBoostClassifier)) and isinstance(
+                getattr(model, 'estimator', None), DecisionTreeClassifier):
+            return
+
+        raise ValueError("Can not compile model of type {}.".format(name))
+
+    @staticmethod
+    def from_forest(forest):
+        """RandomForest / ExtraTrees: average of the class 1 leaf probabilities."""
+
+        CompiledEnsemble.__check_binary(forest)
+
+        n_trees = len(forest.estimators_)
+        trees = [CompiledEnsemble.__sklearn_tree(e, CompiledEnsemble.__leaf_proba(e) / n_trees)
+                 for e in forest.estimators_]
+
+        return CompiledEnsemble.__concat(trees, base=0.0, link='identity', strict=False)
+
+    @staticmethod
+    def from_adaboost(ada):
+        """
+        AdaBoost (binary): sigmoid of the weighted sum of the tree outputs, as in sklearn's predict_proba.
+        SAMME trees output +/-1 (class vote), SAMME.R trees output the log-odds of the leaf probabilities.
+        """
+
+        CompiledEnsemble.__check_binary(ada)
+
+        weights = np.asarray(ada.estimator_weights_, dtype=np.float64)
+        algorithm = getattr(ada, 'algorithm', 'SAMME')
+
+        trees = []
+        for estimator, weight in zip(ada.estimators_, weights):
+            proba = CompiledEnsemble.__leaf_proba(estimator)
+
+            if algorithm == 'SAMME.R':
+                # Binary case of sklearn's _samme_proba: log-odds of the leaf
+                eps = np.finfo(np.float64).eps
+                leaf = np.log(np.clip(proba, eps, None)) - np.log(np.clip(1 - proba, eps, None))
+            else:
+                # Vote of +/- 2w for the predicted class (ties go to class 0, like argmax)
+                leaf = np.where(proba > 0.5, 2 * weight, -2 * weight)
+
+            trees.append(CompiledEnsemble.__sklearn_tree(estimator, leaf / weights.sum()))
+
+        return CompiledEnsemble.__concat(trees, base=0.0, link='sigmoid', strict=False)
+
+    @staticmethod
+    def from_xgboost(model):
+        """XGBoost binary:logistic: sigmoid of the base margin plus the summed leaf values."""
+
+        booster = model.get_booster() if hasattr(model, 'get_booster') else model
+
+        config = json.loads(booster.save_config())
+        objective = config['learner']['objective']['name']
+        if objective != 'binary:logistic':
+            raise ValueError("Only binary:logistic XGBoost models are supported (got {}).".format(objective))
+
+        # base_score is stored as a probability (older versions: "5E-1", newer versions: "[5E-1]")
+        base_score = float(config['learner']['learner_model_param']['base_score'].strip('[]'))
+        base = np.log(base_score / (1 - base_score))
+
+        feature_names = booster.feature_names
+        feature_index = {f: i for i, f in enumerate(feature_names)} if feature_names else None
+
+        trees = [CompiledEnsemble.__xgboost_tree(json.loads(dump), feature_index)
+                 for dump in booster.get_dump(dump_format='json')]
+
+        return CompiledEnsemble.__concat(trees, base=base, link='sigmoid', strict=True)
+
+    @staticmethod
+    def __check_binary(model):
+        if len(model.classes_) != 2:
+            raise ValueError("Only binary classifiers can be compiled.")
+
+    @staticmethod
+    def __leaf_proba(estimator):
+        """Class 1 probability of every node of a fitted sklearn decision tree."""
+
+        value = estimator.tree_.value[:, 0, :]
+        return value[:, 1] / value.sum(axis=1)
+
+    @staticmethod
+    def __sklearn_tree(estimator, leaf_value):
+        tree = estimator.tree_
+        nodes = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+
+        left = np.where(is_leaf, nodes, tree.children_left)
+        right = np.where(is_leaf, nodes, tree.children_right)
+
+        # Trees fitted on data with missing values know per node which way NaN goes, else NaN goes right
+        missing_left = getattr(tree, 'missing_go_to_left', None)
+        missing = right if missing_left is None else np.where(missing_left.astype(bool), left, right)
+
+        return (np.where(is_leaf, 0, tree.feature), np.where(is_leaf, 0.0, tree.threshold), left, right, missing,
+                np.where(is_leaf, leaf_value, 0.0), tree.max_depth)
+
+    @staticmethod
+    def __xgboost_tree(root, feature_index):
+        """Flattens a JSON tree dump (as returned by Booster.get_dump) into node arrays."""
+
+        nodes = []
+        stack = [(root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            nodes.append((node, depth))
+            stack.extend((child, depth + 1) for child in node.get('children', []))
+
+        position = {node['nodeid']: i for i, (node, _) in enumerate(nodes)}
+        size = len(nodes)
+
+        feature = np.zeros(size, dtype=np.int32)
+        threshold = np.zeros(size)
+        left = np.arange(size)
+        right = np.arange(size)
+        missing = np.arange(size)
+        value = np.zeros(size)
+        max_depth = 0
+
+        for i, (node, depth) in enumerate(nodes):
+            max_depth = max(max_depth, depth)
+
+            if 'leaf' in node:
+                value[i] = node['leaf']
+                continue
+
+            split = node['split']
+            feature[i] = feature_index[split] if feature_index else int(split.lstrip('f'))
+            # The dump rounds the float32 threshold to 9 digits, round it back to the exact float32 value
+            threshold[i] = np.float32(node['split_condition'])
+            left[i] = position[node['yes']]
+            right[i] = position[node['no']]
+            missing[i] = position[node.get('missing', node['yes'])]
+
+        return feature, threshold, left, right, missing, value, max_depth
+
+    @staticmethod
+    def __concat(trees, base, link, strict):
+        """Concatenates the node arrays of all trees, offsetting the child indices."""
+
+        arrays = [[] for _ in range(6)]
+        roots = []
+        offset = 0
+        max_depth = 0
+
+        for feature, threshold, left, right, missing, value, depth in trees:
+            roots.append(offset)
+
+            for i, array in enumerate([feature, threshold, np.asarray(left) + offset, np.asarray(right) + offset,
+                                       np.asarray(missing) + offset, value]):
+                arrays[i].append(array)
+
+            offset += len(feature)
+            max_depth = max(max_depth, depth)
+
+        arrays = [np.concatenate(a) if a else np.zeros(0) for a in arrays]
+
+        return CompiledEnsemble(*arrays, roots=roots, max_depth=max_depth, base=base, link=link, strict=strict)
@@ -0,0 +1,292 @@
+import os
+import tempfile
+
+import pandas as pd
+import numpy as np
+from sklearn.base import clone
+from sklearn.metrics import accuracy_score, f1_score, roc_auc_score
+from sklearn.preprocessing import StandardScaler
+
+"""
+Out-of-core counterpart of Classifiers: the feature matrix is never loaded as a whole, but streamed
+from disk in chunks. Supports estimators with partial_fit (e.g. SGDClassifier, GaussianNB, MultinomialNB)
+and XGBClassifier (trained on an external-memory DMatrix).
+
+Example:
+chunks = IncrementalClassifiers.from_files(sorted(glob('../features/run/features_*.pkl')),
+                                           sorted(glob('../features/run/labels_*.npy')))
+classifiers = [
+    {
+        'name': 'SGD',
+        'clf': SGDClassifier(loss='log_loss'),
+        'optimized_param': {'alpha': 1e-4}
+    },
+    {
+        'name': 'MultinomialNB',
+        'clf': MultinomialNB(),
+        // Optional: overrides the scale setting of IncrementalClassifiers for this classifier
+        'scale': False
+    }
+]
+trainer = IncrementalClassifiers(chunks, classifiers)
+trainer.fit(n_epochs=5)
+"""
+
+classes = np.array([0, 1])
+
+
+class IncrementalClassifiers:
+    def __init__(self, chunks, classifiers, scale=True, cache_dir=None):
+        """
+        :param chunks: Callable that returns a new iterator over (features, labels) chunks on every call.
+        :param classifiers: Classifier settings (same format as for Classifiers).
+        :param scale: Standardize the features with statistics that are accumulated over all chunks.
+                      Never applied to estimators that need non-negative input (e.g. MultinomialNB), and can be
+                      overridden per classifier with a 'scale' entry in its settings.
+        :param cache_dir: Directory for the XGBoost external memory cache (defaults to a temporary directory
+                          that is removed after training).
+        """
+
+        self.chunks = chunks
+        self.classifiers = classifiers
+        self.scale = scale
+        self.cache_dir = cache_dir
+
+        self.scaler = None
+        self.columns = None
+
+    @staticmethod
+    def from_files(feature_paths, label_paths):
+        """
+        Chunk source for feature chunks stored as separate files (pickled DataFrames or .npy arrays),
+        with one labels .npy file per feature file.
+        """
+
+        if len(feature_paths) != len(label_paths):
+            raise ValueError("Number of feature files and label files does not match.")
+
+        def chunks():
+            for feature_path, label_path in zip(feature_paths, label_paths):
+                if feature_path.endswith('.npy'):
+                    features = np.load(feature_path)
+                else:
+                    features = pd.read_pickle(feature_path)
+
+                yield features, np.load(label_path)
+
+        return chunks
+
+    @staticmethod
+    def from_npy(feature_path, label_path, chunksize=10000):
+        """Chunk source for a single (large) .npy feature matrix, read through a memory map."""
+
+        def chunks():
+            features = np.load(feature_path, mmap_mode='r')
+            labels = np.load(label_path, mmap_mode='r')
+
+            for start in range(0, features.shape[0], chunksize):
+                yield np.asarray(features[start:start + chunksize]), np.asarray(labels[start:start + chunksize])
+
+        return chunks
+
+    def to_numpy(self, features):
+        """Converts a chunk to a float array, with DataFrame columns aligned to the first chunk."""
+
+        if isinstance(features, pd.DataFrame):
+            if self.columns is None:
+                self.columns = list(features.columns)
+
+            # Columns missing in a chunk are treated as 0
+            features = features.reindex(columns=self.columns, fill_value=0)
+
+        return np.asarray(features, dtype=np.float64)
+
+    def transform(self, features, scale=True):
+        features = self.to_numpy(features)
+
+        if scale and self.scaler is not None:
+            features = self.scaler.transform(features)
+
+        return features
+
+    def fit_scaler(self):
+        """Accumulates the mean and variance of all features in one pass over the chunks."""
+
+        scaler = StandardScaler()
+
+        for features, _ in self.chunks():
+            scaler.partial_fit(self.to_numpy(features))
+
+        self.scaler = scaler
+
+        return scaler
+
+    def _get_clf(self, val):
+        # Fresh copy: every fit starts from scratch and the classifier settings are not modified
+        clf = clone(val['clf'])
+
+        if 'optimized_param' in val:
+            clf = clf.set_params(**val['optimized_param'])
+
+        return clf, val['name']
+
+    def fit(self, n_epochs=1):
+        """
+        Trains all classifiers on the streamed chunks.
+        Estimators with partial_fit do n_epochs passes over the data, XGBoost trains on an external-memory DMatrix.
+        """
+
+        print("-- Start incremental training --")
+
+        for _, val in enumerate(self.classifiers):
+            clf, _ = self._get_clf(val)
+            val['scaled'] = self.__use_scaling(val, clf)
+
+        if self.scaler is None and any(val['scaled'] for val in self.classifiers):
+            self.fit_scaler()
+
+        for _, val in enumerate(self.classifiers):
+            clf, name = self._get_clf(val)
+            scale = val['scaled']
+
+            if self.__is_xgboost(clf):
+                print("Training {} on external memory".format(name))
+                val['incremental_model'] = self.__fit_xgboost(clf, scale)
+
+            elif hasattr(clf, 'partial_fit'):
+                print("Training {} with partial_fit ({} epochs)".format(name, n_epochs))
+
+                for _ in range(n_epochs):
+                    for features, labels in self.chunks():
+                        clf.partial_fit(self.transform(features, scale), labels, classes=classes)
+
+                val['incremental_model'] = clf
+
+            else:
+                print("Classifier {} does not support incremental training, skipping.".format(name))
+
+        print("-- Finished incremental training --")
+
+    def predict_proba(self, val, features):
+        """Returns the clickbait probabilities (or decision scores) of an incrementally trained classifier."""
+
+        model = val['incremental_model']
+        features = self.transform(features, val.get('scaled', True))
+
+        if self.__is_booster(model):
+            import xgboost
+            return model.predict(xgboost.DMatrix(features))
+
+        if hasattr(model, 'predict_proba'):
+            return model.predict_proba(features)[:, 1]
+
+        return model.decision_function(features)
+
+    def score(self, chunks=None, threshold=0.5):
+        """
+        Streams (held-out) chunks through all trained classifiers and reports accuracy, F1 and ROC-AUC.
+        Only the predictions are kept in memory.
+        """
+
+        chunks = chunks if chunks is not None else self.chunks
+        results = dict()
+
+        for _, val in enumerate(self.classifiers):
+            if 'incremental_model' not in val:
+                continue
+
+            y_true = []
+            y_score = []
+            for features, labels in chunks():
+                y_true.append(np.asarray(labels))
+                y_score.append(self.predict_proba(val, features))
+
+            y_true = np.concatenate(y_true)
+            y_score = np.concatenate(y_score)
+
+            # Decision functions are centered around 0 instead of 0.5
+            cut = threshold if hasattr(val['incremental_model'], 'predict_proba') or self.__is_booster(
+                val['incremental_model']) else 0
+            y_preds = (y_score >= cut).astype(int)
+
+            results[val['name']] = {
+                'accuracy': accuracy_score(y_true, y_preds),
+                'f1': f1_score(y_true, y_preds, zero_division=0),
+                'roc_auc': roc_auc_score(y_true, y_score),
+            }
+
+        return pd.DataFrame(results).T
+
+    def __use_scaling(self, val, clf):
+        if 'scale' in val:
+            return val['scale']
+
+        # Standardized features are negative below the mean
+        return self.scale and not self.__requires_positive(clf)
+
+    def __fit_xgboost(self, clf, scale):
+        if self.cache_dir is None:
+            with tempfile.TemporaryDirectory(prefix='xgb_cache_') as cache_dir:
+                return self.__train_xgboost(clf, scale, cache_dir)
+
+        return self.__train_xgboost(clf, scale, self.cache_dir)
+
+    def __train_xgboost(self, clf, scale, cache_dir):
+        import xgboost
+
+        trainer = self
+
+        class ChunkIter(xgboost.DataIter):
+            def __init__(self):
+                self._it = None
+                super().__init__(cache_prefix=os.path.join(cache_dir, 'cache'))
+
+            def next(self, input_data):
+                if self._it is None:
+                    self._it = iter(trainer.chunks())
+
+                try:
+                    features, labels = next(self._it)
+                except StopIteration:
+                    return 0
+
+                input_data(data=trainer.transform(features, scale), label=np.asarray(labels))
+                return 1
+
+            def reset(self):
+                self._it = None
+
+        dtrain = xgboost.DMatrix(ChunkIter())
+
+        params = clf.get_xgb_params()
+        num_boost_round = clf.get_params().get('n_estimators') or 100
+
+        booster = xgboost.train(params, dtrain, num_boost_round=num_boost_round)
+
+        # Release the cache files before the cache directory is removed
+        del dtrain
+
+        return booster
+
+    @staticmethod
+    def __requires_positive(clf):
+        """Whether the estimator only accepts non-negative features (sklearn estimator tags)."""
+
+        if hasattr(clf, '__sklearn_tags__'):
+            try:
+                return clf.__sklearn_tags__().input_tags.positive_only
+            except AttributeError:
+                pass
+
+        if hasattr(clf, '_get_tags'):
+            return clf._get_tags().get('requires_positive_X', False)
+
+        return False
+
+    @staticmethod
+    def __is_xgboost(clf):
+        return type(clf).__module__.startswith('xgboost')
+
+    @staticmethod
+    def __is_booster(model):
+        return type(model).__name__ == 'Booster' and type(model).__module__.startswith('xgboost')
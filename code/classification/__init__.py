@@ -1,3 +1,4 @@
 from .Classifiers import Classifiers
+from .IncrementalClassifiers import IncrementalClassifiers
 
 __version__ = "0.0.1"
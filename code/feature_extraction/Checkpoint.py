@@ -0,0 +1,145 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class Checkpoint:
+    """
+    Stores completed chunks of a feature extraction run in the run directory (features/<run_id>).
+
+    Every chunk is written to its own features_<n>.pkl / labels_<n>.npy pair (plus ngrams_<n>.npz
+    for hashed n-grams), after which the
+    manifest (checkpoint.json) is updated. Files are written to a temporary name and renamed,
+    so an interrupted run never leaves a half-written chunk behind.
+
+    The manifest also records the extraction settings: chunks are only reused by a run with the same settings.
+    """
+
+    manifest_name = 'checkpoint.json'
+
+    def __init__(self, output_path, resume=True, settings=None, fence=None):
+        """
+        :param output_path: Run directory, created if it does not exist.
+        :param resume: Continue from the chunks in an existing manifest, otherwise start a new manifest.
+        :param settings: JSON-serializable extraction settings. Resuming raises a ValueError if the existing
+                         manifest was written with different settings. None only reads the chunks (no check).
+        :param fence: Optional callable that is called before anything is written and raises if this process
+                      may no longer write to the run directory (see PartitionedExtractor).
+        """
+
+        self.output_path = output_path
+        self.fence = fence
+        os.makedirs(output_path, exist_ok=True)
+
+        # Compare settings as they are stored (e.g. tuples become lists)
+        self.settings = json.loads(json.dumps(settings))
+
+        self.chunks = []
+        if resume and os.path.exists(self.__path(self.manifest_name)):
+            with open(self.__path(self.manifest_name), encoding='utf8') as f:
+                manifest = json.load(f)
+
+            stored = manifest.get('settings') or {}
+            current = self.settings or {}
+            changed = sorted(key for key in set(stored) | set(current) if stored.get(key) != current.get(key))
+
+            if manifest['chunks'] and changed and settings is not None:
+                raise ValueError("Can not resume from {}: its chunks were extracted with other settings ({}).".format(
+                    output_path, ", ".join("{}: {} -> {}".format(key, stored.get(key), current.get(key))
+                                           for key in changed)))
+
+            self.chunks = manifest['chunks']
+
+    def completed_ids(self) -> set:
+        """Returns the row ids of all completed chunks."""
+
+        return {row_id for chunk in self.chunks for row_id in chunk['ids']}
+
+    def save_chunk(self, features: pd.DataFrame, labels, ngrams=None) -> None:
+        """Writes a completed chunk (with its optional sparse n-gram matrix) and records it in the manifest."""
+
+        if self.fence is not None:
+            self.fence()
+
+        n = len(self.chunks)
+        feature_file = 'features_{:05d}.pkl'.format(n)
+        label_file = 'labels_{:05d}.npy'.format(n)
+
+        self.__atomic(feature_file, lambda path: features.to_pickle(path, compression=None))
+        self.__atomic(label_file, lambda path: np.save(path, np.asarray(labels), allow_pickle=True), '.npy')
+
+        chunk = {'features': feature_file, 'labels': label_file,
+                 'ids': [self.__to_json(row_id) for row_id in features.index]}
+
+        if ngrams is not None:
+            chunk['ngrams'] = 'ngrams_{:05d}.npz'.format(n)
+            self.__atomic(chunk['ngrams'], lambda path: sparse.save_npz(path, sparse.csr_matrix(ngrams)), '.npz')
+
+        self.chunks.append(chunk)
+
+        self.__atomic(self.manifest_name, self.__write_manifest)
+
+    def load(self, index=None):
+        """
+        Reads all completed chunks and returns (labels, features).
+        If index is given, rows are returned in that order.
+        """
+
+        if not self.chunks:
+            return np.zeros(0), pd.DataFrame()
+
+        features = pd.concat([pd.read_pickle(self.__path(chunk['features'])) for chunk in self.chunks])
+        labels = np.concatenate([np.load(self.__path(chunk['labels']), allow_pickle=True) for chunk in self.chunks])
+
+        if index is not None:
+            order = features.index.get_indexer(index)
+
+            if (order < 0).any():
+                raise ValueError("Checkpoint does not contain all requested rows.")
+
+            features = features.iloc[order]
+            labels = labels[order]
+
+        return labels, features
+
+    def load_ngrams(self, index=None):
+        """
+        Reads the n-gram matrices of all completed chunks, or returns None if the chunks have none.
+        If index is given, rows are returned in that order.
+        """
+
+        if not self.chunks or any('ngrams' not in chunk for chunk in self.chunks):
+            return None
+
+        ngrams = sparse.vstack([sparse.load_npz(self.__path(chunk['ngrams'])) for chunk in self.chunks], format='csr')
+
+        if index is not None:
+            order = pd.Index([row_id for chunk in self.chunks for row_id in chunk['ids']]).get_indexer(index)
+
+            if (order < 0).any():
+                raise ValueError("Checkpoint does not contain all requested rows.")
+
+            ngrams = ngrams[order]
+
+        return ngrams
+
+    def __write_manifest(self, path):
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump({'settings': self.settings, 'chunks': self.chunks}, f)
+
+    def __atomic(self, name, write, suffix=''):
+        # Temp file keeps the suffix, as np.save appends '.npy' otherwise
+        tmp = self.__path(name + '.tmp' + suffix)
+        write(tmp)
+        os.replace(tmp, self.__path(name))
+
+    def __path(self, name):
+        return os.path.join(self.output_path, name)
+
+    @staticmethod
+    def __to_json(row_id):
+        # Tweet ids are numpy integers in the dataframe index
+        return row_id.item() if isinstance(row_id, np.generic) else row_id
@@ -3,22 +3,56 @@ from itertools import combinations
 
 import pandas as pd
 
-from .WordTools import WordTools
+from .WordTools import WordTools, WTReturn
 from .Util import Util
 from .ImageHelper import ImageHelper
+from .LongTextProcessor import LongTextProcessor
+from .SimilarityFeatures import SimilarityFeatures
+from .Checkpoint import Checkpoint
+from .LanguageFilter import LanguageFilter
+from .HashedPerceptronTagger import HashedPerceptronTagger
 
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
 
 
 class FeatureExtractor:
     required_cols = ['postText', 'targetKeywords', 'targetDescription', 'targetTitle', 'targetParagraphs']
+    tag_sets = [{'NNP'}, {'DT'}, {'PRP'}]
+
+    # Fields that can be used for n-gram features (the article fields only with article_based)
+    ngram_fields = ['post_title', 'article_title', 'article_kw', 'article_desc']
 
     df = None
     processed = False
+    routes = None
+    ngrams = None
+
+    def __init__(self, data_path, tesseract_path, max_paragraphs=None, max_paragraph_tokens=None, n_jobs=1,
+                 tagger=None, image_options=None):
+        """
+        :param data_path: Path to the dataset directory.
+        :param tesseract_path: Absolute path to the Tesseract-OCR executable.
+        :param max_paragraphs: Only use the first N article paragraphs for the article features.
+        :param max_paragraph_tokens: Token budget over all article paragraphs for the article features.
+        :param n_jobs: Number of processes used to tag article paragraphs (spread over the rows of a chunk).
+        :param tagger: PoS tagger backend (see PosTagger) or path to a saved HashedPerceptronTagger.
+                       Defaults to NLTK's averaged perceptron.
+        :param image_options: Keyword arguments for ImageHelper, e.g. {'preprocess': True, 'text_filter': True}.
+        """
+
+        # Settings that change the extracted features (recorded in checkpoints)
+        self.settings = {'tagger': tagger if isinstance(tagger, str) else type(tagger).__name__ if tagger else None,
+                         'max_paragraphs': max_paragraphs, 'max_paragraph_tokens': max_paragraph_tokens,
+                         'image_options': image_options or {}}
 
-    def __init__(self, data_path, tesseract_path):
-        self.wordtools = WordTools()
-        self.imagehelper = ImageHelper(data_path, tesseract_path)
+        if isinstance(tagger, str):
+            tagger = HashedPerceptronTagger.load(tagger)
+
+        self.wordtools = WordTools(tagger)
+        self.imagehelper = ImageHelper(data_path, tesseract_path, **(image_options or {}))
+        self.longtext = LongTextProcessor(self.wordtools, max_paragraphs, max_paragraph_tokens, self.tag_sets, n_jobs)
+        self.similarity = SimilarityFeatures()
+        self.languagefilter = LanguageFilter()
         self.sid = SentimentIntensityAnalyzer()
 
     def set_df(self, df: pd.DataFrame, processed=False) -> None:
@@ -34,38 +68,193 @@ class FeatureExtractor:
         self.df = df.copy()
         self.processed = processed
 
-    def extract_features(self, char_based=True, word_based=True, pos_based=True, sent_based=True, debug=True):
+    def extract_features(self, char_based=True, word_based=True, pos_based=True, sent_based=True, article_based=False,
+                         sim_based=False, debug=True, output_path=None, chunksize=1000, resume=False, classes=None,
+                         prefilter=False, ngram_hasher=None, ngram_fields=('post_title', 'article_title'),
+                         fence=None):
         """
         Extracts the relevant features from a Pandas dataframe.
+
+        Set article_based to also compute word and PoS features for the article keywords, description and paragraphs.
+        Set sim_based to add the similarities between post title, article title, description and paragraphs.
+
+        If output_path (the run directory) is given, every chunk of chunksize rows is checkpointed there
+        as soon as it is done. With resume, rows in an earlier checkpoint of that run are skipped; resuming
+        a run that was started with other settings raises a ValueError. fence is passed on to Checkpoint.
+
+        Pass classes (e.g. ['no-clickbait', 'clickbait']) to map truth classes to fixed integer labels
+        instead of numbering them in order of appearance.
+
+        With prefilter, rows with (near-)empty or non-English titles (see LanguageFilter) skip OCR and all NLP
+        processing: they only get the character-based features, with defaults for the other features.
+        The route of every row is stored in FeatureExtractor.routes. The language filter has to be fitted and
+        calibrated first, e.g. fe.languagefilter.fit().calibrate(texts, is_english) on a hand-labelled sample.
+
+        With an ngram_hasher (see NgramHasher), the word and PoS n-grams of ngram_fields are hashed from the
+        tokens and tags computed for the other features. The sparse matrix is stored in FeatureExtractor.ngrams,
+        in the same row order as the features; pass it as sparse_features to Classifiers.
         """
 
-        if self.df is None:
-            raise ValueError(
-                "No dataframe defined. Please call " + '\033[1m' + "FeatureExtractor.set_df()" + '\033[0m' + " first.")
+        self.__check_df()
+
+        available = self.ngram_fields if article_based else self.ngram_fields[:2]
+        if ngram_hasher is not None and not set(ngram_fields).issubset(available):
+            raise ValueError("N-gram fields must be in {}".format(available))
 
         # Get targets
-        labels = self.__get_targets(self.df['truthClass'])
+        labels = self.__get_targets(self.df['truthClass'], classes)
+
+        # For partitioned execution over multiple processes / hosts, see PartitionedExtractor
+
+        # Open the checkpoint first: resuming with other settings fails before any work is done
+        checkpoint = None
+        if output_path is not None:
+            settings = dict(self.settings, processed=self.processed, char_based=char_based, word_based=word_based,
+                            pos_based=pos_based, sent_based=sent_based, article_based=article_based, debug=debug,
+                            classes=classes, prefilter=prefilter, ngram_fields=ngram_fields,
+                            ngram_hasher=self.__get_hasher_settings(ngram_hasher))
+
+            checkpoint = Checkpoint(output_path, resume, settings, fence)
 
-        # TODO: optionally convert to dask partitions and parellelize
-        # ddata = dd.from_pandas(self.df, npartitions=8)
-        # features = ddata.map_partitions(
-        #     lambda df: df.apply(lambda x: self.__get_features(x, char_based, word_based, pos_based, sim_based, debug),
-        #                         axis=1)).compute(scheduler='threads')
+        # Route rows that can not yield meaningful NLP features to the cheap path
+        self.routes = None
+        if prefilter:
+            self.routes = self.__get_routes()
+
+            print("Pre-filter routes:")
+            print(LanguageFilter.report(self.routes).to_string())
+
+        def get_features(df):
+            # PoS-tagged tokens per row, for the n-grams of this chunk only
+            tagged = dict() if ngram_hasher is not None else None
+
+            cheap = pd.Series(False, index=df.index)
+            if self.routes is not None:
+                cheap = self.routes.loc[df.index] != 'ok'
+
+            # The paragraphs of all rows of the chunk are processed at once (in parallel with n_jobs > 1)
+            article_par = dict()
+            if article_based:
+                articles = df.loc[~cheap.values, 'targetParagraphs']
+                article_par = dict(zip(articles.index, self.longtext.process_all(articles, self.processed)))
+
+            features = df.apply(
+                lambda x: self.__get_features(x, char_based, word_based, pos_based, sent_based, article_based, debug,
+                                              cheap=cheap[x.name], tagged=tagged, proc_par=article_par.get(x.name)),
+                axis=1)
+
+            if ngram_hasher is None:
+                return features, None
+
+            return features, ngram_hasher.transform(
+                [(name, [word for word, _ in tagged[row_id][name]], [tag for _, tag in tagged[row_id][name]])
+                 for name in ngram_fields] for row_id in df.index)
 
         # Get features
-        features = self.df.apply(lambda x: self.__get_features(x, char_based, word_based, pos_based, sent_based, debug),
-                                 axis=1)
+        try:
+            if output_path is None:
+                features, self.ngrams = get_features(self.df)
+            else:
+                features, self.ngrams = self.__extract_checkpointed(get_features, labels, checkpoint, chunksize)
+        finally:
+            self.longtext.close()
+            self.imagehelper.close()
+
+        # Similarity features are computed for all rows at once
+        if sim_based and not debug:
+            features = features.join(self.extract_sim_features())
 
         return labels, features
 
-    def __get_targets(self, truth_classes: pd.Series) -> pd.Series:
+    def extract_sim_features(self) -> pd.DataFrame:
+        """
+        Computes the similarity features (see SimilarityFeatures) of all rows of the dataframe.
+        The TF-IDF weights depend on all rows, so this is done in one go instead of per chunk.
+        """
+
+        self.__check_df()
+
+        return self.__get_sim_features()
+
+    def __extract_checkpointed(self, get_features, labels, checkpoint, chunksize):
+        """
+        Extracts features chunk by chunk, writing each chunk to the run directory, and returns all features
+        and n-grams (including those of earlier runs when resuming) in dataframe order.
+        """
+
+        # Skip rows that are already done
+        todo = ~self.df.index.isin(list(checkpoint.completed_ids()))
+        todo_positions = todo.nonzero()[0]
+
+        print("Extracting {} rows ({} done in earlier runs)".format(len(todo_positions), len(self.df) - todo.sum()))
+
+        for start in range(0, len(todo_positions), chunksize):
+            positions = todo_positions[start:start + chunksize]
+
+            features, ngrams = get_features(self.df.iloc[positions])
+            checkpoint.save_chunk(features, labels[positions], ngrams)
+
+            print("Checkpoint: {}/{} rows".format(start + len(positions), len(todo_positions)))
+
+        _, features = checkpoint.load(self.df.index)
+
+        return features, checkpoint.load_ngrams(self.df.index)
+
+    @staticmethod
+    def __get_hasher_settings(hasher):
+        return hasher.get_settings() if hasher is not None else None
+
+    def __get_routes(self) -> pd.Series:
+        """Routes every row based on the post title and article title (more text makes detection more reliable)."""
+
+        post_title = self.df['postText']
+
+        if not self.processed:
+            post_title = post_title.apply(lambda x: x[0] if x else "")
+
+        texts = post_title.fillna("") + " " + self.df['targetTitle'].fillna("")
+
+        return self.languagefilter.route_series(texts)
+
+    def __check_df(self):
+        if self.df is None:
+            raise ValueError(
+                "No dataframe defined. Please call " + '\033[1m' + "FeatureExtractor.set_df()" + '\033[0m' + " first.")
+
+    def __get_targets(self, truth_classes: pd.Series, classes=None) -> pd.Series:
         """
         Maps categorical truth classes to integer targets.
         """
 
+        if classes is not None:
+            labels = pd.Categorical(truth_classes, categories=classes).codes
+
+            if (labels < 0).any():
+                raise ValueError("Unknown truth classes: {}".format(set(truth_classes[labels < 0])))
+
+            return labels.astype(int)
+
         labels, _ = pd.factorize(truth_classes, sort=False)
         return labels
 
+    def __get_sim_features(self) -> pd.DataFrame:
+        """
+        Computes the bag-of-words similarities between the post and article fields.
+        """
+
+        post_title = self.df['postText']
+
+        if not self.processed:
+            post_title = post_title.apply(lambda x: x[0] if isinstance(x, list) and x else "")
+
+        fields = OrderedDict()
+        fields['post_title'] = post_title
+        fields['article_title'] = self.df['targetTitle']
+        fields['article_desc'] = self.df['targetDescription']
+        fields['article_par'] = self.df['targetParagraphs']
+
+        return self.similarity.get_features(fields, self.df.index)
+
     def dict2feature(self, features, name: str, data: dict) -> None:
         """Append feature name to dict key and append to features."""
 
@@ -78,9 +267,13 @@ class FeatureExtractor:
         for var1, var2 in combinations(data, 2):
             features["{}_{}_{}".format(name, var1, var2)] = func(data[var1], data[var2])
 
-    def __get_features(self, row, char_based=True, word_based=True, pos_based=True, sent_based=True, debug=True):
+    def __get_features(self, row, char_based=True, word_based=True, pos_based=True, sent_based=True,
+                       article_based=False, debug=True, cheap=False, tagged=None, proc_par=None):
         """
         Extracts features from dataset row.
+        With cheap, OCR and NLP processing are skipped (empty results) and sentiment defaults to -1.
+        If tagged is a dict, the PoS-tagged tokens of the title (and article) fields are stored in it by row id.
+        proc_par are the paragraph counts of the row, if already computed (see LongTextProcessor.process_all).
 
         TODO: check if it makes sense to calculate the average keyword length as opposed to the total word length: says so in the paper, but seems strange
         """
@@ -102,16 +295,35 @@ class FeatureExtractor:
         article_par = row['targetParagraphs']
 
         # Prep
-        proc_post_title = self.wordtools.process(post_title, 35, self.processed)
-        proc_article_title = self.wordtools.process(article_title, 35, self.processed)
+        if cheap:
+            # Pre-filtered row: same features, without the expensive processing
+            post_image = ""
+            proc_post_title = proc_article_title = proc_post_image = WTReturn([], [], [], [])
+            proc_article_kw = proc_article_desc = WTReturn([], [], [], [])
+            proc_article_par = self.longtext.process([])
 
-        if not self.processed:
-            post_image = self.imagehelper.get_text(post_image)
+        else:
+            proc_post_title = self.wordtools.process(post_title, 35, self.processed)
+            proc_article_title = self.wordtools.process(article_title, 35, self.processed)
+
+            if not self.processed:
+                post_image = self.imagehelper.get_text(post_image)
+
+            proc_post_image = self.wordtools.process(post_image, 100, self.processed)
+
+            if article_based:
+                proc_article_kw = self.wordtools.process(article_kw, 100, self.processed)
+                proc_article_desc = self.wordtools.process(article_desc, 100, self.processed)
+
+                # Paragraphs are reduced to counts (sum and mean over paragraphs)
+                proc_article_par = proc_par if proc_par is not None else self.longtext.process(article_par,
+                                                                                                 self.processed)
 
-        proc_post_image = self.wordtools.process(post_image, 100, self.processed)
-        # proc_article_kw = self.wordtools.process(article_kw, 100, self.processed)
-        # proc_article_desc = self.wordtools.process(article_desc, 100, self.processed)
-        # proc_article_par = self.wordtools.process_list(article_par, None, self.processed)
+        if tagged is not None:
+            tagged[row.name] = {'post_title': proc_post_title.pos, 'article_title': proc_article_title.pos}
+
+            if article_based:
+                tagged[row.name].update(article_kw=proc_article_kw.pos, article_desc=proc_article_desc.pos)
 
         if debug:
             features['proc_post_title'] = proc_post_title
@@ -153,9 +365,6 @@ class FeatureExtractor:
             num_words['post_title'] = Util.count_words(proc_post_title.words)
             num_words['article_title'] = Util.count_words(proc_article_title.words)
             num_words['post_image'] = Util.count_words(proc_post_image.words)
-            # num_words['article_kw'] = Util.count_words(proc_article_kw.words)
-            # num_words['article_desc'] = Util.count_words(proc_article_desc.words)
-            # num_words['article_par'] = Util.count_words(proc_article_par.words)
 
             # Calculate num uppercase words
             num_uppercase = OrderedDict()
@@ -170,18 +379,32 @@ class FeatureExtractor:
             num_formal_words['post_title'] = Util.count_words(proc_post_title.formal_words)
             num_formal_words['article_title'] = Util.count_words(proc_article_title.formal_words)
             num_formal_words['post_image'] = Util.count_words(proc_post_image.formal_words)
-            # num_formal_words['article_kw'] = Util.count_words(proc_article_kw.formal_words)
-            # num_formal_words['article_desc'] = Util.count_words(proc_article_desc.formal_words)
-            # num_formal_words['article_par'] = Util.count_words(proc_article_par.formal_words)
 
             # Calculate num stop words
             num_stopwords = OrderedDict()
             num_stopwords['post_title'] = Util.count_words(proc_post_title.stopwords)
             num_stopwords['article_title'] = Util.count_words(proc_article_title.stopwords)
             num_stopwords['post_image'] = Util.count_words(proc_post_image.stopwords)
-            # num_stopwords['article_kw'] = Util.count_words(proc_article_kw.stopwords)
-            # num_stopwords['article_desc'] = Util.count_words(proc_article_desc.stopwords)
-            # num_stopwords['article_par'] = Util.count_words(proc_article_par.stopwords)
+
+            if article_based:
+                for name, proc in (('article_kw', proc_article_kw), ('article_desc', proc_article_desc)):
+                    num_words[name] = Util.count_words(proc.words)
+                    num_titlecase[name], num_uppercase[name] = Util.count_words_case(proc.words)
+                    num_formal_words[name] = Util.count_words(proc.formal_words)
+                    num_stopwords[name] = Util.count_words(proc.stopwords)
+
+                # Average per paragraph (as Util.count_words does for nested lists)
+                num_words['article_par'] = proc_article_par.mean['words']
+                num_titlecase['article_par'] = proc_article_par.mean['titlecase']
+                num_uppercase['article_par'] = proc_article_par.mean['uppercase']
+                num_formal_words['article_par'] = proc_article_par.mean['formal_words']
+                num_stopwords['article_par'] = proc_article_par.mean['stopwords']
+
+                # Totals over the (truncated) article body
+                features['numParagraphs_article_par'] = proc_article_par.num_paragraphs
+                features['sumWords_article_par'] = proc_article_par.sum['words']
+                features['sumFormalWords_article_par'] = proc_article_par.sum['formal_words']
+                features['sumStopWords_article_par'] = proc_article_par.sum['stopwords']
 
             # Similarity bag-of-words
             features['sim_post_title_article_title'] = Util.count_words_intersection(proc_post_title.words,
@@ -208,15 +431,18 @@ class FeatureExtractor:
 
         if pos_based:
 
-            tags = [{'NNP'}, {'DT'}, {'PRP'}]
-
-            for tag_set in tags:
+            for tag_set in self.tag_sets:
                 # Count tags
                 num_pos_tags = OrderedDict()
                 num_pos_tags['post_title'] = Util.count_tags(proc_post_title.pos, tag_set)
                 num_pos_tags['article_title'] = Util.count_tags(proc_article_title.pos, tag_set)
                 # num_pos_tags['post_image'] = Util.count_tags(proc_post_image.pos, tag_set)
 
+                if article_based:
+                    num_pos_tags['article_kw'] = Util.count_tags(proc_article_kw.pos, tag_set)
+                    num_pos_tags['article_desc'] = Util.count_tags(proc_article_desc.pos, tag_set)
+                    num_pos_tags['article_par'] = proc_article_par.mean[repr(tag_set)]
+
                 # Generate features
                 self.dict2feature(features, 'numTags' + repr(tag_set), num_pos_tags)
                 self.combi_dict2feature(features, 'ratioTags_' + repr(tag_set), num_pos_tags, Util.ratio_raw)
@@ -224,8 +450,8 @@ class FeatureExtractor:
 
         if sent_based:
             sentiment = OrderedDict()
-            sentiment['post_title'] = self.__get_sent(post_title)
-            sentiment['article_title'] = self.__get_sent(article_title)
+            sentiment['post_title'] = self.__get_sent(post_title if not cheap else None)
+            sentiment['article_title'] = self.__get_sent(article_title if not cheap else None)
             # sentiment['post_image'] = self.__get_sent(post_image)
             # sentiment['article_kw'] = self.__get_sent(article_kw)
             # sentiment['article_desc'] = self.__get_sent(article_desc)
@@ -0,0 +1,258 @@
+import json
+import random
+import zlib
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from .PosTagger import PosTagger
+
+"""
+Greedy averaged perceptron PoS tagger with hashed features and NumPy weights.
+
+Uses the feature templates of NLTK's averaged perceptron plus word shape features (which help on
+title-cased headlines). Feature strings are hashed (crc32, stable across processes) into n_buckets
+rows of a (n_buckets, n_tags) weight matrix, so there is no feature dictionary. All sentences of a
+batch are tagged position by position: every step scores the current token of all sentences with one
+gather + sum over the weight matrix.
+
+Run the Tagger Test notebook (accuracy and speed compared with NltkTagger) before switching to it.
+
+Example:
+tagger = HashedPerceptronTagger()
+tagger.train(tagged_sents, n_iter=5)  # e.g. nltk.corpus.treebank.tagged_sents()
+tagger.save('tagger.npz')
+fe = FeatureExtractor(data_path, tesseract_path, tagger='tagger.npz')
+"""
+
+START = ['-START-', '-START2-']
+END = ['-END-', '-END2-']
+
+# Multiplier to combine a hashed feature with a tag index
+MIX = 0x9E3779B1
+
+
+def _hash(feature):
+    return zlib.crc32(feature.encode('utf8'))
+
+
+class HashedPerceptronTagger(PosTagger):
+    def __init__(self, n_buckets=2 ** 18, tags=None, weights=None, tagdict=None, tag_map=None):
+        """
+        :param n_buckets: Number of hash buckets (rows of the weight matrix).
+        :param tags: List of tags (columns of the weight matrix), set by train().
+        :param weights: Weight matrix of shape (n_buckets, len(tags)), set by train().
+        :param tagdict: Frequent unambiguous words -> tag; these words are not scored.
+        :param tag_map: Function applied to the training tags (e.g. reduce_tag from PosTagger) to train on fewer tags.
+        """
+
+        self.n_buckets = n_buckets
+        self.tags = list(tags) if tags is not None else []
+        self.weights = weights
+        self.tagdict = tagdict if tagdict is not None else dict()
+        self.tag_map = tag_map
+
+    def tag_sents(self, sentences):
+        """Tags a batch of tokenized sentences."""
+
+        sentences = [list(sent) for sent in sentences]
+        tag_ids = [[-1] * len(sent) for sent in sentences]
+
+        if self.weights is None:
+            raise ValueError("Tagger is not trained. Please call train() or load() first.")
+
+        static = [self.__static_features(sent) for sent in sentences]
+        max_len = max((len(sent) for sent in sentences), default=0)
+
+        for i in range(max_len):
+            active = []
+            rows = []
+
+            for s, sent in enumerate(sentences):
+                if i >= len(sent):
+                    continue
+
+                tag = self.tagdict.get(sent[i])
+                if tag is not None:
+                    tag_ids[s][i] = tag
+                    continue
+
+                active.append(s)
+                rows.append(static[s][i] + self.__dynamic_features(sent, tag_ids[s], i))
+
+            if not active:
+                continue
+
+            # Score the current token of all active sentences at once
+            scores = self.weights[np.asarray(rows)].sum(axis=1)
+            best = scores.argmax(axis=1)
+
+            for s, tag in zip(active, best):
+                tag_ids[s][i] = int(tag)
+
+        return [list(zip(sent, (self.tags[t] for t in ids))) for sent, ids in zip(sentences, tag_ids)]
+
+    def train(self, tagged_sents, n_iter=5, seed=0):
+        """
+        Trains the averaged perceptron on a list of [(word, tag), ...] sentences.
+        """
+
+        tagged_sents = [[(word, self.tag_map(tag) if self.tag_map else tag) for word, tag in sent]
+                        for sent in tagged_sents]
+
+        self.tags = sorted({tag for sent in tagged_sents for _, tag in sent})
+        self.tagdict = self.__make_tagdict(tagged_sents)
+        tag_index = {tag: i for i, tag in enumerate(self.tags)}
+
+        n_tags = len(self.tags)
+        self.weights = np.zeros((self.n_buckets, n_tags), dtype=np.float32)
+
+        # Lazy averaging: accumulated weights and the step at which each weight last changed
+        totals = np.zeros((self.n_buckets, n_tags), dtype=np.float64)
+        tstamps = np.zeros((self.n_buckets, n_tags), dtype=np.int64)
+        step = 0
+
+        sentences = list(tagged_sents)
+        rng = random.Random(seed)
+
+        for iteration in range(n_iter):
+            correct = 0
+            total = 0
+
+            for sent in sentences:
+                words = [word for word, _ in sent]
+                static = self.__static_features(words)
+                tag_ids = []
+
+                for i, (word, tag) in enumerate(sent):
+                    truth = tag_index[tag]
+                    guess = self.tagdict.get(word)
+
+                    if guess is None:
+                        features = np.asarray(static[i] + self.__dynamic_features(words, tag_ids, i))
+                        guess = int(self.weights[features].sum(axis=0).argmax())
+                        step += 1
+
+                        if guess != truth:
+                            for cls, delta in ((truth, 1.0), (guess, -1.0)):
+                                totals[features, cls] += (step - tstamps[features, cls]) * self.weights[features, cls]
+                                tstamps[features, cls] = step
+                                np.add.at(self.weights[:, cls], features, delta)
+
+                    tag_ids.append(guess)
+                    correct += guess == truth
+                    total += 1
+
+            rng.shuffle(sentences)
+            print("Iteration {}: {}/{} = {:.4f}".format(iteration + 1, correct, total, correct / max(total, 1)))
+
+        # Average the weights over all steps
+        totals += (step - tstamps) * self.weights
+        self.weights = (totals / max(step, 1)).astype(np.float32)
+
+        return self
+
+    def save(self, path):
+        np.savez_compressed(path, weights=self.weights,
+                            meta=np.array(json.dumps({'n_buckets': self.n_buckets, 'tags': self.tags,
+                                                      'tagdict': {w: self.tags[t] for w, t in self.tagdict.items()}})))
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as arrays:
+            meta = json.loads(str(arrays['meta']))
+            tag_index = {tag: i for i, tag in enumerate(meta['tags'])}
+
+            return HashedPerceptronTagger(meta['n_buckets'], meta['tags'], arrays['weights'],
+                                          {w: tag_index[t] for w, t in meta['tagdict'].items()})
+
+    def __make_tagdict(self, tagged_sents, freq_thresh=20, ambiguity_thresh=0.97):
+        """Frequent words that (almost) always have the same tag, as in NLTK's perceptron tagger."""
+
+        counts = defaultdict(Counter)
+        for sent in tagged_sents:
+            for word, tag in sent:
+                counts[word][tag] += 1
+
+        tag_index = {tag: i for i, tag in enumerate(self.tags)}
+        tagdict = dict()
+
+        for word, tag_freqs in counts.items():
+            tag, mode = tag_freqs.most_common(1)[0]
+            n = sum(tag_freqs.values())
+
+            if n >= freq_thresh and mode / n >= ambiguity_thresh:
+                tagdict[word] = tag_index[tag]
+
+        return tagdict
+
+    def __static_features(self, words):
+        """Hashed features that do not depend on the predicted tags, per token."""
+
+        context = START + [self.__normalize(w) for w in words] + END
+        features = []
+
+        for i, word in enumerate(words):
+            j = i + 2
+            w = context[j]
+
+            templates = [
+                'bias',
+                'suf ' + w[-3:],
+                'pre ' + w[:1],
+                'w ' + w,
+                'w-1 ' + context[j - 1],
+                'suf-1 ' + context[j - 1][-3:],
+                'w-2 ' + context[j - 2],
+                'w+1 ' + context[j + 1],
+                'suf+1 ' + context[j + 1][-3:],
+                'w+2 ' + context[j + 2],
+                'shape ' + self.__shape(word),
+                'shape first ' + self.__shape(word) if i == 0 else 'not first',
+            ]
+
+            features.append([_hash(t) % self.n_buckets for t in templates])
+
+        return features
+
+    def __dynamic_features(self, words, tag_ids, i):
+        """Hashed features that depend on the tags predicted for the previous two tokens."""
+
+        # Tag indices of START symbols are placed after the real tags
+        p1 = tag_ids[i - 1] if i >= 1 else len(self.tags)
+        p2 = tag_ids[i - 2] if i >= 2 else len(self.tags) + 1
+
+        word_hash = _hash('t-1 w ' + self.__normalize(words[i]))
+
+        return [
+            (_hash('t-1') + (p1 + 1) * MIX) % self.n_buckets,
+            (_hash('t-2') + (p2 + 1) * MIX) % self.n_buckets,
+            (_hash('t-1 t-2') + ((p1 + 1) * 1000 + p2 + 1) * MIX) % self.n_buckets,
+            (word_hash + (p1 + 1) * MIX) % self.n_buckets,
+        ]
+
+    @staticmethod
+    def __normalize(word):
+        """Word normalization of NLTK's perceptron tagger."""
+
+        if '-' in word and word[0] != '-':
+            return '!HYPHEN'
+        if word.isdigit() and len(word) == 4:
+            return '!YEAR'
+        if word and word[0].isdigit():
+            return '!DIGITS'
+
+        return word.lower()
+
+    @staticmethod
+    def __shape(word):
+        if word.isupper():
+            return 'upper'
+        if word.istitle():
+            return 'title'
+        if word.islower():
+            return 'lower'
+        if word.isdigit():
+            return 'digit'
+
+        return 'other'
@@ -0,0 +1,236 @@
+import re
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+"""
+Cheap pre-filter that decides, before any NLP processing, whether a row can yield meaningful features.
+
+Rows are routed to:
+    - 'ok': regular feature extraction
+    - 'empty': (near-)empty text
+    - 'non_english': text in another script, or whose character trigrams are closer to another language
+
+Languages are compared with the out-of-place rank distance of Cavnar & Trenkle (1994): the trigrams of
+the text and of every language profile are ranked by frequency, and the distance sums how far each trigram
+of the text is displaced in the profile. A text is only marked non-English if a competing language is
+closer than English by at least min_margin; calibrate() sets min_margin from labelled examples.
+
+Nothing is routed before fit() built the profiles and min_margin was calibrate()d (or set explicitly):
+the defaults have not been validated on the corpus. fit() defaults to the An Crubadan trigram frequencies
+in NLTK (nltk.download('crubadan')).
+Very short texts are never marked non-English, as language detection on a few words is unreliable
+(see the Corpus Language Test notebook).
+"""
+
+word_pattern = re.compile(r"[^\W\d_]+")
+
+
+class LanguageFilter:
+    routes = ['ok', 'empty', 'non_english']
+
+    # English first, then the languages most likely to show up in the (English) clickbait corpus
+    languages = ['eng', 'fra', 'deu', 'spa', 'ita', 'nld', 'por', 'swe', 'dan', 'pol', 'tur', 'ind']
+
+    def __init__(self, min_chars=3, min_ascii_ratio=0.5, min_margin=None, min_trigrams=12, profile_size=300,
+                 languages=None):
+        """
+        :param min_chars: Texts with fewer letters are considered empty.
+        :param min_ascii_ratio: Minimum fraction of ASCII letters (lower means another script).
+        :param min_margin: Minimum score (see score()) for a text to be considered English.
+                           None until calibrate() sets it.
+        :param min_trigrams: Only score texts with at least this many character trigrams.
+        :param profile_size: Number of most frequent trigrams per language profile.
+        :param languages: Language codes of the profiles, English ('eng') first.
+        """
+
+        self.min_chars = min_chars
+        self.min_ascii_ratio = min_ascii_ratio
+        self.min_margin = min_margin
+        self.min_trigrams = min_trigrams
+        self.profile_size = profile_size
+
+        if languages is not None:
+            self.languages = list(languages)
+
+        self.profiles = None
+
+    def fit(self, texts=None):
+        """
+        Builds the ranked trigram profile of every language.
+
+        :param texts: Dict of language code -> iterable of texts in that language.
+                      Defaults to the An Crubadan trigram frequencies of self.languages.
+        """
+
+        if texts is None:
+            counts = self.__crubadan_counts()
+        else:
+            counts = dict()
+            for lang, lang_texts in texts.items():
+                if isinstance(lang_texts, str):
+                    lang_texts = [lang_texts]
+
+                counts[lang] = Counter()
+                for text in lang_texts:
+                    counts[lang].update(self.get_trigrams(self.get_words(text)))
+
+        if self.languages[0] not in counts:
+            raise ValueError("No texts for the English profile ('{}').".format(self.languages[0]))
+
+        self.languages = [self.languages[0]] + [lang for lang in counts if lang != self.languages[0]]
+        self.profiles = {lang: self.__ranks(counts[lang]) for lang in self.languages}
+
+        return self
+
+    @staticmethod
+    def get_words(text):
+        return word_pattern.findall(text.lower()) if text else []
+
+    @staticmethod
+    def get_trigrams(words):
+        # Word boundaries as in the An Crubadan profiles
+        for word in words:
+            padded = "<{}>".format(word)
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3]
+
+    def distances(self, words) -> dict:
+        """Normalized out-of-place distance (0 = same ranking, 1 = no trigrams in common) to every language."""
+
+        if self.profiles is None:
+            raise ValueError("No language profiles, call LanguageFilter.fit() first.")
+
+        ranks = self.__ranks(Counter(self.get_trigrams(words)))
+
+        if not ranks:
+            return {lang: 1.0 for lang in self.languages}
+
+        trigrams = list(ranks)
+        text_ranks = np.array([ranks[trigram] for trigram in trigrams])
+
+        distances = dict()
+        for lang in self.languages:
+            profile = self.profiles[lang]
+            lang_ranks = np.array([profile.get(trigram, -1) for trigram in trigrams])
+
+            # Trigrams missing in the profile get the maximum displacement
+            displacement = np.where(lang_ranks < 0, self.profile_size, np.abs(text_ranks - lang_ranks))
+            distances[lang] = float(displacement.sum()) / (len(trigrams) * self.profile_size)
+
+        return distances
+
+    def score(self, words) -> float:
+        """
+        Distance of the closest other language minus the distance to English.
+        Positive means the text is closer to English than to any other language.
+        """
+
+        distances = self.distances(words)
+        english = distances.pop(self.languages[0])
+
+        return min(distances.values()) - english if distances else 1.0
+
+    def route(self, text) -> str:
+        """Returns the route ('ok', 'empty' or 'non_english') for a single text."""
+
+        self.__check_ready()
+
+        words = self.get_words(text)
+        letters = "".join(words)
+
+        if len(letters) < self.min_chars:
+            return 'empty'
+
+        if sum(1 for c in letters if c < '\x80') / len(letters) < self.min_ascii_ratio:
+            return 'non_english'
+
+        if self.count_trigrams(words) >= self.min_trigrams and self.score(words) < self.min_margin:
+            return 'non_english'
+
+        return 'ok'
+
+    def route_series(self, texts: pd.Series) -> pd.Series:
+        self.__check_ready()
+
+        return texts.apply(self.route)
+
+    def count_trigrams(self, words) -> int:
+        return sum(1 for _ in self.get_trigrams(words))
+
+    def calibrate(self, texts, is_english) -> pd.DataFrame:
+        """
+        Sets min_margin to the threshold with the highest accuracy on labelled texts (e.g. a hand-labelled
+        sample of the corpus) and returns the accuracy, precision and recall of the non-English route per
+        candidate threshold. Only texts that are long enough to be scored are used.
+        """
+
+        scores = []
+        labels = []
+        for text, english in zip(texts, is_english):
+            words = self.get_words(text)
+
+            if len("".join(words)) >= self.min_chars and self.count_trigrams(words) >= self.min_trigrams:
+                scores.append(self.score(words))
+                labels.append(bool(english))
+
+        if not scores:
+            raise ValueError("None of the texts is long enough to calibrate on.")
+
+        scores = np.array(scores)
+        non_english = ~np.array(labels)
+
+        # Candidate thresholds halfway between consecutive scores (plus one below all scores)
+        values = np.unique(scores)
+        thresholds = np.r_[values[0] - 1e-6, (values[:-1] + values[1:]) / 2, values[-1] + 1e-6]
+
+        results = []
+        for threshold in thresholds:
+            predicted = scores < threshold
+            tp = (predicted & non_english).sum()
+
+            results.append({'threshold': threshold,
+                            'accuracy': (predicted == non_english).mean(),
+                            'precision': tp / predicted.sum() if predicted.sum() else 1.0,
+                            'recall': tp / non_english.sum() if non_english.sum() else 1.0})
+
+        results = pd.DataFrame(results)
+
+        # Highest accuracy; on ties the lowest threshold (fewest rows routed away from NLP processing)
+        self.min_margin = float(results.loc[results['accuracy'].idxmax(), 'threshold'])
+
+        return results
+
+    @staticmethod
+    def report(routes: pd.Series) -> pd.Series:
+        """Number of rows per route."""
+
+        return routes.value_counts().reindex(LanguageFilter.routes, fill_value=0)
+
+    def __ranks(self, counts):
+        """Trigram -> rank of the profile_size most frequent trigrams."""
+
+        return {trigram: rank for rank, (trigram, _) in enumerate(counts.most_common(self.profile_size))}
+
+    def __check_ready(self):
+        if self.profiles is None:
+            raise ValueError("No language profiles, call LanguageFilter.fit() first.")
+
+        if self.min_margin is None:
+            raise ValueError("min_margin is not calibrated, call LanguageFilter.calibrate() on labelled texts "
+                             "(or set min_margin explicitly).")
+
+    def __crubadan_counts(self):
+        from nltk.corpus import crubadan
+
+        counts = dict()
+        for lang in self.languages:
+            counts[lang] = Counter(dict(crubadan.lang_freq(lang)))
+
+            # The profiles must use the same trigrams as get_trigrams: 3 characters, words padded with < and >
+            if not counts[lang] or any(len(trigram) != 3 for trigram in counts[lang]) or not any(
+                    trigram[0] == '<' for trigram in counts[lang]):
+                raise ValueError("Unexpected An Crubadan trigram profile for '{}'.".format(lang))
+
+        return counts
@@ -0,0 +1,165 @@
+from collections import OrderedDict, namedtuple
+from multiprocessing import Pool
+
+from .WordTools import WordTools
+from .Util import Util
+
+LTReturn = namedtuple('LTReturn', ['sum', 'mean', 'num_paragraphs'])
+
+# Per-process WordTools instance, created by the pool initializer
+_worker_tools = None
+
+
+def _init_worker(tagger):
+    global _worker_tools
+    _worker_tools = WordTools(tagger)
+
+
+def _count_worker(args):
+    paragraphs, processed, tag_sets = args
+    return LongTextProcessor.count_paragraphs(_worker_tools, paragraphs, processed, tag_sets)
+
+
+class LongTextProcessor:
+    """
+    Processes long texts (e.g. targetParagraphs) through WordTools one article at a time.
+
+    The (truncated) paragraphs of an article are PoS-tagged with a single tag_sents call, and each paragraph
+    is reduced to a handful of counts right after tagging, so the per-paragraph WTReturn lists are never
+    kept around. Only the sums and means per article are returned.
+    """
+
+    def __init__(self, wordtools, max_paragraphs=None, max_tokens=None, tag_sets=None, n_jobs=1, chunksize=4):
+        """
+        :param wordtools: WordTools instance used in the main process.
+        :param max_paragraphs: Only process the first N (non-empty) paragraphs.
+        :param max_tokens: Total token budget over all paragraphs (whitespace tokens, applied before tokenizing).
+        :param tag_sets: List of PoS tag sets to count, e.g. [{'NNP'}, {'DT'}, {'PRP'}].
+        :param n_jobs: Number of worker processes that process_all spreads the articles over (1 = in-process).
+        :param chunksize: Number of articles sent to a worker at once.
+        """
+
+        self.wordtools = wordtools
+        self.max_paragraphs = max_paragraphs
+        self.max_tokens = max_tokens
+        self.tag_sets = tag_sets if tag_sets is not None else []
+        self.n_jobs = n_jobs
+        self.chunksize = chunksize
+
+        self._pool = None
+
+    def __getstate__(self):
+        # Worker pools can not be pickled (e.g. when the extractor is shipped to another process)
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def close(self):
+        """Shuts down the worker pool, if any."""
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def truncate(self, paragraphs):
+        """
+        Lazily yields the paragraphs that fit in the configured paragraph and token budgets.
+        The last paragraph is cut off when it exceeds the remaining token budget.
+        """
+
+        if not paragraphs:
+            return
+
+        if isinstance(paragraphs, str):
+            paragraphs = [paragraphs]
+
+        num_paragraphs = 0
+        budget = self.max_tokens
+
+        for paragraph in paragraphs:
+
+            # Skip empty paragraphs
+            if not paragraph or not paragraph.strip():
+                continue
+
+            if self.max_paragraphs is not None and num_paragraphs >= self.max_paragraphs:
+                return
+
+            if budget is not None:
+                if budget <= 0:
+                    return
+
+                tokens = paragraph.split()
+                if len(tokens) > budget:
+                    paragraph = " ".join(tokens[:budget])
+
+                budget -= len(tokens)
+
+            num_paragraphs += 1
+            yield paragraph
+
+    def process(self, paragraphs, processed=False):
+        """
+        Processes the paragraphs of a single article in-process and returns the summed and averaged counts (LTReturn).
+        """
+
+        paragraphs = list(self.truncate(paragraphs))
+
+        return self.__reduce(self.count_paragraphs(self.wordtools, paragraphs, processed, self.tag_sets))
+
+    def process_all(self, articles, processed=False):
+        """
+        Processes the paragraphs of multiple articles and returns an LTReturn per article.
+        With n_jobs > 1 the articles are spread over the worker processes, chunksize articles at a time.
+        """
+
+        jobs = ((list(self.truncate(paragraphs)), processed, self.tag_sets) for paragraphs in articles)
+
+        if self.n_jobs is None or self.n_jobs <= 1:
+            results = (self.count_paragraphs(self.wordtools, *job) for job in jobs)
+        else:
+            if self._pool is None:
+                self._pool = Pool(self.n_jobs, initializer=_init_worker, initargs=(self.wordtools.tagger,))
+
+            results = self._pool.imap(_count_worker, jobs, chunksize=self.chunksize)
+
+        return [self.__reduce(counts) for counts in results]
+
+    def __reduce(self, paragraph_counts):
+        totals = OrderedDict((key, 0) for key in self.count_keys(self.tag_sets))
+
+        for counts in paragraph_counts:
+            for key, value in counts.items():
+                totals[key] += value
+
+        num_paragraphs = len(paragraph_counts)
+        means = OrderedDict((key, value / num_paragraphs if num_paragraphs > 0 else 0) for key, value in totals.items())
+
+        return LTReturn(totals, means, num_paragraphs)
+
+    @staticmethod
+    def count_keys(tag_sets):
+        return ['words', 'formal_words', 'stopwords', 'titlecase', 'uppercase'] + [repr(t) for t in tag_sets]
+
+    @staticmethod
+    def count_paragraphs(wordtools, paragraphs, processed, tag_sets):
+        """Tags the paragraphs of an article at once and reduces the result to counts per paragraph."""
+
+        return [LongTextProcessor.count_result(proc, tag_sets)
+                for proc in wordtools.process_batch(paragraphs, None, processed)]
+
+    @staticmethod
+    def count_result(proc, tag_sets):
+        """Reduces the WTReturn of a single paragraph to counts."""
+
+        counts = OrderedDict()
+        counts['words'] = Util.count_words(proc.words)
+        counts['formal_words'] = Util.count_words(proc.formal_words)
+        counts['stopwords'] = Util.count_words(proc.stopwords)
+        counts['titlecase'], counts['uppercase'] = Util.count_words_case(proc.words)
+
+        for tag_set in tag_sets:
+            counts[repr(tag_set)] = Util.count_tags(proc.pos, tag_set)
+
+        return counts
@@ -0,0 +1,68 @@
+from nltk import ngrams
+from scipy import sparse
+from sklearn.feature_extraction import FeatureHasher
+
+
+class NgramHasher:
+    """
+    Maps word and PoS-tag n-grams to a sparse matrix of fixed width with the hashing trick.
+
+    No vocabulary is kept in memory: every n-gram is hashed straight to a column index,
+    so the output width only depends on n_features.
+    """
+
+    def __init__(self, n_features=2 ** 20, word_range=(1, 3), pos_range=(2, 3), binary=False):
+        """
+        :param n_features: Number of columns of the hashed feature matrix.
+        :param word_range: (min_n, max_n) for word n-grams, or None to skip.
+        :param pos_range: (min_n, max_n) for PoS-tag n-grams, or None to skip.
+        :param binary: Only record n-gram presence instead of counts.
+        """
+
+        self.n_features = n_features
+        self.word_range = word_range
+        self.pos_range = pos_range
+        self.binary = binary
+
+        self.hasher = FeatureHasher(n_features=n_features, input_type='string', alternate_sign=False)
+
+    def get_settings(self) -> dict:
+        """Constructor arguments of this hasher, e.g. to record it in a checkpoint or recreate it in another process."""
+
+        return {'n_features': self.n_features, 'word_range': self.word_range, 'pos_range': self.pos_range,
+                'binary': self.binary}
+
+    def get_terms(self, name, words, tags):
+        """
+        Yields the n-gram terms of one field.
+        Terms are prefixed with the field name and the n-gram type, e.g. 'post_title:w:you will'.
+        """
+
+        if self.word_range:
+            words = [word.lower() for word in words]
+            for term in self.__get_ngrams(words, *self.word_range):
+                yield "{}:w:{}".format(name, term)
+
+        if self.pos_range:
+            for term in self.__get_ngrams(tags, *self.pos_range):
+                yield "{}:p:{}".format(name, term)
+
+    def transform(self, rows) -> sparse.csr_matrix:
+        """
+        Hashes an iterable of rows into a CSR matrix.
+        Each row is an iterable of (field name, words, PoS tags) tuples.
+        """
+
+        terms = ([term for field in row for term in self.get_terms(*field)] for row in rows)
+        matrix = self.hasher.transform(terms).tocsr()
+
+        if self.binary:
+            matrix.data[:] = 1
+
+        return matrix
+
+    @staticmethod
+    def __get_ngrams(tokens, min_n, max_n):
+        for n in range(min_n, max_n + 1):
+            for gram in ngrams(tokens, n):
+                yield " ".join(gram)
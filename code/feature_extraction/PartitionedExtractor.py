@@ -0,0 +1,455 @@
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+
+from .Checkpoint import Checkpoint
+from .NgramHasher import NgramHasher
+
+"""
+Partitioned feature extraction over multiple processes and/or hosts.
+
+plan() splits the input JSONL in one pass into partitions by a hash of the id and writes a shard
+(instances + truth) per partition. Hashing instead of id ranges: the (tweet) ids are not spread evenly,
+and ranges would need a first pass over the input to find balanced boundaries. Workers only need access to a shared directory: they claim a partition
+by atomically creating a claim file, extract their shard with checkpointing into partition_<n>/
+(see Checkpoint) and mark it done.
+
+While a worker extracts a partition, a heartbeat thread keeps its claim fresh. Claims without a heartbeat
+for stale_after seconds (the worker died) are taken over; the new worker resumes from the partition
+checkpoint. Every claim has its own token: a worker checks its token before writing a chunk and stops
+working on the partition when it has lost the claim.
+
+sim_based features depend on all rows (TF-IDF weights), so they are not computed per partition
+but once in merge(). With an ngram_hasher in extract_kwargs, the plan stores its settings and every
+worker hashes the n-grams of its partition; merge() combines them in the same row order as the features.
+
+Example (local cluster with 4 worker processes):
+pe = PartitionedExtractor('../features/run', n_partitions=16)
+pe.plan('../data/clickbait17-train-170331', extract_kwargs={'debug': False})
+labels, features = pe.run_local(n_workers=4)
+
+Workers on other hosts (with the same shared directory mounted):
+python -m feature_extraction.PartitionedExtractor worker ../features/run
+"""
+
+
+def _worker_main(shared_dir):
+    PartitionedExtractor(shared_dir).run_worker()
+
+
+class PartitionedExtractor:
+    config_name = 'partitions.json'
+
+    ngrams = None
+
+    def __init__(self, shared_dir, n_partitions=8, stale_after=600):
+        """
+        :param shared_dir: Directory shared by all workers; holds the plan, shards, claims and partition outputs.
+        :param n_partitions: Number of partitions to split the input in.
+        :param stale_after: Seconds without heartbeat after which a claimed partition may be taken over.
+                            The heartbeat is sent every stale_after / 4 seconds.
+        """
+
+        self.shared_dir = shared_dir
+        self.n_partitions = n_partitions
+        self.stale_after = stale_after
+
+        self.config = None
+
+    def plan(self, dataset_path, tesseract_path=None, extractor_kwargs=None, extract_kwargs=None,
+             classes=('no-clickbait', 'clickbait')):
+        """
+        Splits <dataset_path>/instances.jsonl and truth.jsonl in one pass into per-partition shards and
+        writes the plan (including the extractor settings) to the shared directory.
+        The settings must be JSON serializable, except for an ngram_hasher in extract_kwargs.
+        """
+
+        # Similarities are computed once over all rows in merge()
+        extract_kwargs = dict(extract_kwargs or {})
+        sim_based = extract_kwargs.pop('sim_based', False)
+
+        # Workers recreate the hasher from its settings
+        ngram_hasher = extract_kwargs.pop('ngram_hasher', None)
+
+        config = {
+            'dataset_path': dataset_path,
+            'tesseract_path': tesseract_path,
+            'extractor_kwargs': extractor_kwargs or {},
+            'extract_kwargs': extract_kwargs,
+            'sim_based': sim_based and not extract_kwargs.get('debug', True),
+            'ngram_hasher': ngram_hasher.get_settings() if ngram_hasher is not None else None,
+            'classes': list(classes),
+            'n_partitions': self.n_partitions,
+        }
+
+        # Fail before writing any shards
+        try:
+            json.dumps(config)
+        except TypeError as e:
+            raise ValueError("Extractor settings can not be stored in the plan: {}".format(e))
+
+        os.makedirs(self.__path('shards'), exist_ok=True)
+
+        sizes = self.__write_shards(os.path.join(dataset_path, 'instances.jsonl'), 'instances')
+        self.__write_shards(os.path.join(dataset_path, 'truth.jsonl'), 'truth')
+
+        if not sum(sizes):
+            raise ValueError("No instances found in {}".format(dataset_path))
+
+        partitions = [{'partition': i, 'size': size} for i, size in enumerate(sizes) if size > 0]
+
+        self.config = dict(config, partitions=partitions)
+
+        tmp = self.__path(self.config_name + '.tmp')
+        with open(tmp, 'w', encoding='utf8') as f:
+            json.dump(self.config, f, indent=2)
+        os.replace(tmp, self.__path(self.config_name))
+
+        return partitions
+
+    def run_worker(self):
+        """Claims and extracts partitions until none are left. Returns the processed partition numbers."""
+
+        from .FeatureExtractor import FeatureExtractor
+
+        config = self.__load_config()
+        fe = FeatureExtractor(config['dataset_path'], config['tesseract_path'], **config['extractor_kwargs'])
+
+        extract_kwargs = dict(config['extract_kwargs'])
+        if config.get('ngram_hasher'):
+            extract_kwargs['ngram_hasher'] = NgramHasher(**config['ngram_hasher'])
+
+        processed = []
+        while True:
+            claim = self.__claim_next()
+
+            if claim is None:
+                break
+
+            partition, token = claim
+            print("[{}] Extracting partition {}".format(self.__worker_name(), partition['partition']))
+
+            heartbeat = threading.Event()
+            threading.Thread(target=self.__heartbeat, args=(partition, token, heartbeat), daemon=True).start()
+
+            try:
+                fe.set_df(self.load_partition(partition))
+                fe.extract_features(output_path=self.__partition_dir(partition), resume=True,
+                                    classes=config['classes'], fence=lambda: self.__check_claim(partition, token),
+                                    **extract_kwargs)
+
+                # Mark as done before releasing the claim, so the partition is never picked up twice
+                self.__check_claim(partition, token)
+                open(os.path.join(self.__partition_dir(partition), 'done'), 'w').close()
+
+            except ClaimLostError as e:
+                print("[{}] {}".format(self.__worker_name(), e))
+                continue
+
+            finally:
+                heartbeat.set()
+
+            self.__release(partition, token)
+            processed.append(partition['partition'])
+
+        return processed
+
+    def run_local(self, n_workers=None):
+        """Runs the workers as separate local processes, waits for them and merges the output."""
+
+        n_workers = n_workers or os.cpu_count()
+
+        # Spawn instead of fork: workers should behave exactly like workers on other hosts
+        ctx = get_context('spawn')
+        workers = [ctx.Process(target=_worker_main, args=(self.shared_dir,)) for _ in range(n_workers)]
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+        if failed:
+            print("{} worker(s) failed, exit codes: {}".format(len(failed), failed))
+
+        return self.merge()
+
+    def merge(self, write=True):
+        """
+        Combines the partition outputs into one feature DataFrame, sorted by id, and adds the similarity
+        features if planned. Every partition must contain exactly the ids of its shard.
+        The n-grams (if planned) are stored in PartitionedExtractor.ngrams, in the same row order as the features.
+        With write, features.pkl and labels.npy (and ngrams.npz) are written to the shared directory
+        (as in the notebooks).
+        """
+
+        config = self.__load_config()
+
+        missing = [p['partition'] for p in config['partitions']
+                   if not os.path.exists(os.path.join(self.__partition_dir(p), 'done'))]
+        if missing:
+            raise ValueError("Partitions not finished yet: {}".format(missing))
+
+        all_labels = []
+        all_features = []
+        all_ngrams = []
+        for partition in config['partitions']:
+            checkpoint = Checkpoint(self.__partition_dir(partition))
+            labels, features = checkpoint.load()
+            self.__check_partition(partition, features.index, config['n_partitions'])
+
+            all_labels.append(labels)
+            all_features.append(features)
+
+            if config.get('ngram_hasher'):
+                ngrams = checkpoint.load_ngrams(features.index)
+
+                if ngrams is None:
+                    raise ValueError("Partition {} has no n-grams.".format(partition['partition']))
+
+                all_ngrams.append(ngrams)
+
+        features = pd.concat(all_features)
+        labels = np.concatenate(all_labels)
+
+        # Deterministic order, regardless of which worker finished first
+        order = np.argsort(features.index.to_numpy(), kind='mergesort')
+        features = features.iloc[order]
+        labels = labels[order]
+
+        self.ngrams = sparse.vstack(all_ngrams, format='csr')[order] if all_ngrams else None
+
+        if config['sim_based']:
+            features = features.join(self.__get_sim_features(config))
+
+        if write:
+            features.to_pickle(self.__path('features.pkl'))
+            np.save(self.__path('labels.npy'), labels, allow_pickle=True)
+
+            if self.ngrams is not None:
+                sparse.save_npz(self.__path('ngrams.npz'), self.ngrams)
+
+        return labels, features
+
+    def status(self):
+        """Returns the state (todo, claimed or done) of every partition."""
+
+        config = self.__load_config()
+        status = dict()
+
+        for partition in config['partitions']:
+            if os.path.exists(os.path.join(self.__partition_dir(partition), 'done')):
+                status[partition['partition']] = 'done'
+            elif os.path.exists(self.__claim_path(partition)):
+                status[partition['partition']] = 'claimed'
+            else:
+                status[partition['partition']] = 'todo'
+
+        return status
+
+    def load_partition(self, partition) -> pd.DataFrame:
+        """Reads the instances and truth shard of a partition."""
+
+        instances = list(self.__read_jsonl(self.__shard_path(partition, 'instances')))
+        truth = [{'id': row['id'], 'truthClass': row['truthClass']}
+                 for row in self.__read_jsonl(self.__shard_path(partition, 'truth'))]
+
+        df = pd.DataFrame(instances)
+        df['id'] = df['id'].astype(np.int64)
+        df.set_index('id', inplace=True)
+
+        df_truth = pd.DataFrame(truth)
+        df_truth['id'] = df_truth['id'].astype(np.int64)
+        df_truth.set_index('id', inplace=True)
+
+        return df.join(df_truth[['truthClass']])
+
+    def __write_shards(self, path, kind):
+        """Copies the lines of a JSONL file to the shard of their partition and returns the number of rows per shard."""
+
+        names = [self.__shard_path({'partition': i}, kind) for i in range(self.n_partitions)]
+        files = [open(name + '.tmp', 'w', encoding='utf8') for name in names]
+        sizes = [0] * self.n_partitions
+
+        try:
+            with open(path, encoding='utf8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+
+                    i = self.get_partition(json.loads(line)['id'], self.n_partitions)
+                    files[i].write(line if line.endswith('\n') else line + '\n')
+                    sizes[i] += 1
+        finally:
+            for file in files:
+                file.close()
+
+        for name in names:
+            os.replace(name + '.tmp', name)
+
+        return sizes
+
+    @staticmethod
+    def get_partition(row_id, n_partitions):
+        """Partition of a row id (stable across processes and hosts)."""
+
+        return zlib.crc32(str(int(row_id)).encode('utf8')) % n_partitions
+
+    def __check_partition(self, partition, index, n_partitions):
+        """Verifies that a partition output holds every id of its shard exactly once."""
+
+        if not index.is_unique:
+            raise ValueError("Partition {} contains duplicate ids.".format(partition['partition']))
+
+        if len(index) != partition['size']:
+            raise ValueError("Partition {} contains {} rows instead of {}.".format(partition['partition'], len(index),
+                                                                                 partition['size']))
+
+        if any(self.get_partition(row_id, n_partitions) != partition['partition'] for row_id in index):
+            raise ValueError("Partition {} contains ids of other partitions.".format(partition['partition']))
+
+    def __get_sim_features(self, config) -> pd.DataFrame:
+        from .FeatureExtractor import FeatureExtractor
+
+        fe = FeatureExtractor(config['dataset_path'], config['tesseract_path'], **config['extractor_kwargs'])
+        fe.set_df(pd.concat([self.load_partition(partition) for partition in config['partitions']]))
+
+        return fe.extract_sim_features()
+
+    def __claim_next(self):
+        """
+        Claims the first partition that is not done and not (actively) claimed by another worker.
+        Returns (partition, claim token) or None.
+        """
+
+        for partition in self.__load_config()['partitions']:
+            if os.path.exists(os.path.join(self.__partition_dir(partition), 'done')):
+                continue
+
+            token = self.__try_claim(partition)
+            if token is not None:
+                return partition, token
+
+        return None
+
+    def __try_claim(self, partition):
+        claim = self.__claim_path(partition)
+
+        if os.path.exists(claim) and self.__is_stale(partition):
+            # Only one worker can win the rename of a stale claim
+            try:
+                os.rename(claim, "{}.stale.{}".format(claim, self.__worker_name()))
+            except OSError:
+                return None
+
+        try:
+            fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+
+        token = uuid.uuid4().hex
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': self.__worker_name(), 'token': token, 'time': time.time()}, f)
+
+        return token
+
+    def __heartbeat(self, partition, token, stop):
+        """Refreshes the claim every stale_after / 4 seconds, as long as it is ours and stop is not set."""
+
+        while not stop.wait(self.stale_after / 4):
+            try:
+                self.__check_claim(partition, token)
+                os.utime(self.__claim_path(partition))
+            except (ClaimLostError, OSError):
+                return
+
+    def __check_claim(self, partition, token):
+        """Raises a ClaimLostError if the claim on the partition is no longer held with this token."""
+
+        try:
+            with open(self.__claim_path(partition), encoding='utf8') as f:
+                current = json.load(f).get('token')
+        except (OSError, ValueError):
+            current = None
+
+        if current != token:
+            raise ClaimLostError("Lost the claim on partition {} to another worker.".format(partition['partition']))
+
+    def __release(self, partition, token):
+        try:
+            self.__check_claim(partition, token)
+            os.remove(self.__claim_path(partition))
+        except (ClaimLostError, FileNotFoundError):
+            pass
+
+    def __is_stale(self, partition):
+        """A claim is stale if it was not refreshed (heartbeat) for stale_after seconds."""
+
+        try:
+            last_activity = os.path.getmtime(self.__claim_path(partition))
+        except OSError:
+            return False
+
+        return time.time() - last_activity > self.stale_after
+
+    def __load_config(self):
+        if self.config is None:
+            with open(self.__path(self.config_name), encoding='utf8') as f:
+                self.config = json.load(f)
+
+        return self.config
+
+    def __partition_dir(self, partition):
+        return self.__path('partition_{:05d}'.format(partition['partition']))
+
+    def __claim_path(self, partition):
+        return self.__path('partition_{:05d}.claim'.format(partition['partition']))
+
+    def __shard_path(self, partition, kind):
+        return os.path.join(self.shared_dir, 'shards', 'partition_{:05d}.{}.jsonl'.format(partition['partition'], kind))
+
+    def __path(self, name):
+        return os.path.join(self.shared_dir, name)
+
+    @staticmethod
+    def __worker_name():
+        return "{}-{}".format(socket.gethostname(), os.getpid())
+
+    @staticmethod
+    def __read_jsonl(path):
+        with open(path, encoding='utf8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class ClaimLostError(RuntimeError):
+    """Raised when a worker's claim on a partition was taken over by another worker."""
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Partitioned feature extraction.")
+    parser.add_argument('command', choices=['worker', 'merge', 'status'])
+    parser.add_argument('shared_dir')
+    args = parser.parse_args()
+
+    extractor = PartitionedExtractor(args.shared_dir)
+
+    if args.command == 'worker':
+        extractor.run_worker()
+    elif args.command == 'merge':
+        extractor.merge()
+    else:
+        print(extractor.status())
@@ -0,0 +1,100 @@
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+
+import pandas as pd
+from nltk import pos_tag, pos_tag_sents
+
+"""
+Part-of-Speech tagger backends for WordTools.
+
+A tagger turns a list of tokens into a list of (token, tag) tuples (Penn Treebank tags).
+NltkTagger is the default (NLTK's averaged perceptron). HashedPerceptronTagger is an alternative; the
+Tagger Test notebook compares both (PosTagger.compare) on the Penn Treebank sample in NLTK.
+"""
+
+# Tags consumed downstream: the counted tag sets, the punctuation / digit filters in WordTools
+# and the first letter (N, V, J, R) used for the WordNet lookup
+kept_tags = {'NNP', 'DT', 'PRP', 'CD', '.', ':', ',', "''", '$', '``', '(', ')'}
+coarse_tags = {'N': 'NN', 'V': 'VB', 'J': 'JJ', 'R': 'RB'}
+
+
+def reduce_tag(tag):
+    """
+    Maps a Penn Treebank tag to a reduced tag set that gives the same word, PoS and WordNet features.
+    PoS n-grams (NgramHasher) do change, as they use the tags directly.
+    """
+
+    if tag in kept_tags:
+        return tag
+
+    return coarse_tags.get(tag[:1], 'XX')
+
+
+class PosTagger(ABC):
+    """Tagger interface."""
+
+    def tag(self, tokens):
+        return self.tag_sents([tokens])[0]
+
+    @abstractmethod
+    def tag_sents(self, sentences):
+        pass
+
+    def evaluate(self, tagged_sents, tag_map=None, tags=('NNP', 'DT', 'PRP')) -> OrderedDict:
+        """
+        Tags the sentences of a tagged corpus and returns the accuracy, the number of tokens per second and,
+        for every tag in tags (by default the counted tag sets of FeatureExtractor), the accuracy on the
+        tokens with that gold tag and the precision of the predicted tag.
+        Optionally maps both the gold and predicted tags with tag_map (e.g. reduce_tag) first.
+        """
+
+        sentences = [[word for word, _ in sent] for sent in tagged_sents]
+
+        start = time.perf_counter()
+        predicted = self.tag_sents(sentences)
+        duration = time.perf_counter() - start
+
+        correct = Counter()
+        gold_total = Counter()
+        pred_total = Counter()
+        for gold_sent, pred_sent in zip(tagged_sents, predicted):
+            for (_, gold), (_, pred) in zip(gold_sent, pred_sent):
+                if tag_map is not None:
+                    gold, pred = tag_map(gold), tag_map(pred)
+
+                correct[gold] += gold == pred
+                gold_total[gold] += 1
+                pred_total[pred] += 1
+
+        total = sum(gold_total.values())
+
+        result = OrderedDict()
+        result['accuracy'] = sum(correct.values()) / total if total else 0
+        result['tokens_per_second'] = total / duration if duration else 0
+
+        for tag in tags:
+            result['accuracy_' + tag] = correct[tag] / gold_total[tag] if gold_total[tag] else float('nan')
+            result['precision_' + tag] = correct[tag] / pred_total[tag] if pred_total[tag] else float('nan')
+
+        return result
+
+    @staticmethod
+    def compare(taggers: dict, tagged_sents, tag_map=None, tags=('NNP', 'DT', 'PRP')) -> pd.DataFrame:
+        """Evaluates multiple taggers (name -> tagger) on the same tagged corpus (see evaluate)."""
+
+        results = OrderedDict()
+        for name, tagger in taggers.items():
+            results[name] = tagger.evaluate(tagged_sents, tag_map, tags)
+
+        return pd.DataFrame(results).T
+
+
+class NltkTagger(PosTagger):
+    """NLTK's averaged perceptron tagger (nltk.pos_tag)."""
+
+    def tag(self, tokens):
+        return pos_tag(tokens)
+
+    def tag_sents(self, sentences):
+        return pos_tag_sents(sentences)
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from itertools import chain, combinations
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+from sklearn.preprocessing import normalize
+
+
+class SimilarityFeatures:
+    """
+    Computes bag-of-words similarities between text fields for all rows at once.
+
+    All fields share one vocabulary and are stored as rows of a single CSR matrix, so the
+    similarities reduce to row-wise sparse products instead of building Python sets per row.
+    """
+
+    def __init__(self, max_features=None, min_df=1):
+        """
+        :param max_features: Cap the shared vocabulary to the N most frequent terms.
+        :param min_df: Ignore terms that occur in fewer than min_df documents (over all fields).
+        """
+
+        self.max_features = max_features
+        self.min_df = min_df
+
+    @staticmethod
+    def to_text(obj):
+        """Flattens a field value (string, list of strings or empty) to a single string."""
+
+        if isinstance(obj, str):
+            return obj
+
+        # Missing values (None, or NaN as pandas reads missing strings)
+        if not isinstance(obj, (list, tuple, np.ndarray)):
+            return ""
+
+        return " ".join(item for item in obj if isinstance(item, str) and item)
+
+    def get_features(self, fields: OrderedDict, index=None) -> pd.DataFrame:
+        """
+        Returns Jaccard, cosine and TF-IDF cosine similarities for every pair of fields.
+
+        :param fields: Field name -> iterable of texts (all of equal length, one text per row).
+        :param index: Index of the resulting DataFrame.
+        """
+
+        names = list(fields.keys())
+        texts = [[self.to_text(x) for x in fields[name]] for name in names]
+        num_rows = len(texts[0]) if texts else 0
+
+        # Build the shared vocabulary and tokenize every field in one pass (keep single-character words)
+        vectorizer = CountVectorizer(lowercase=True, token_pattern=r"(?u)\b\w+\b", max_features=self.max_features,
+                                     min_df=self.min_df)
+
+        try:
+            counts = vectorizer.fit_transform(chain(*texts)).tocsr()
+        except ValueError:
+            # Empty vocabulary (e.g. only empty texts)
+            counts = None
+
+        features = OrderedDict()
+
+        if counts is None:
+            for name1, name2 in combinations(names, 2):
+                for metric in ['simJaccard', 'simCosine', 'simTfidf']:
+                    features["{}_{}_{}".format(metric, name1, name2)] = np.zeros(num_rows)
+
+            return pd.DataFrame(features, index=index)
+
+        binary = counts.copy()
+        binary.data[:] = 1
+
+        cosine = normalize(counts, norm='l2', copy=True)
+        tfidf = TfidfTransformer().fit_transform(counts)
+
+        def field(matrix, i):
+            return matrix[i * num_rows:(i + 1) * num_rows]
+
+        for (i1, name1), (i2, name2) in combinations(enumerate(names), 2):
+            suffix = "{}_{}".format(name1, name2)
+
+            features['simJaccard_' + suffix] = self.jaccard(field(binary, i1), field(binary, i2))
+            features['simCosine_' + suffix] = self.rowwise_dot(field(cosine, i1), field(cosine, i2))
+            features['simTfidf_' + suffix] = self.rowwise_dot(field(tfidf, i1), field(tfidf, i2))
+
+        return pd.DataFrame(features, index=index)
+
+    @staticmethod
+    def rowwise_dot(left, right):
+        """Row-wise inner product of two sparse matrices with the same shape."""
+
+        return np.asarray(left.multiply(right).sum(axis=1)).ravel()
+
+    @staticmethod
+    def jaccard(left, right):
+        """
+        Row-wise Jaccard index of two binary sparse matrices.
+        Returns 0 for rows where either side is empty (as Util.count_words_intersection does).
+        """
+
+        intersection = SimilarityFeatures.rowwise_dot(left, right)
+        union = np.diff(left.indptr) + np.diff(right.indptr) - intersection
+
+        result = np.zeros(len(intersection))
+        mask = intersection > 0
+        result[mask] = intersection[mask] / union[mask]
+
+        return result
@@ -1,9 +1,11 @@
 from collections import namedtuple
 
-from nltk import download, word_tokenize, pos_tag, WordNetLemmatizer, ngrams
+from nltk import download, word_tokenize, WordNetLemmatizer
 from nltk.data import find
 from nltk.corpus import wordnet as wn, stopwords as sw
 
+from .PosTagger import NltkTagger
+
 WTReturn = namedtuple('WTReturn', ['words', 'formal_words', 'stopwords', 'pos'])
 rng_WTReturn = range(0, len(WTReturn._fields))
 
@@ -16,13 +18,17 @@ class WordTools:
     morphy_tag = {'NN': wn.NOUN, 'JJ': wn.ADJ,
                   'VB': wn.VERB, 'RB': wn.ADV}
 
-    def __init__(self):
+    def __init__(self, tagger=None):
+        """
+        :param tagger: PoS tagger backend (see PosTagger), defaults to NLTK's averaged perceptron.
+        """
 
         # Download required NLTK libraries
         self.__nltk_init()
 
         self.lem = WordNetLemmatizer()
         self.stopwords = sw.words('english')
+        self.tagger = tagger if tagger is not None else NltkTagger()
 
     def preprocess(self, sentence):
 
@@ -44,6 +50,28 @@ class WordTools:
         Optionally filters stopwords and/or cardinal digits.
         """
 
+        return self.process_batch([sentence], max_words, processed, remove_digits, remove_stopwords, batch=False)[0]
+
+    def process_batch(self, sentences, max_words=None, processed=False, remove_digits=False, remove_stopwords=False,
+                      batch=True):
+        """
+        Same as process, for a list of sentences (e.g. the paragraphs of an article).
+        The sentences are PoS-tagged with a single tag_sents call of the tagger.
+        """
+
+        token_lists = [self.__tokenize(sentence, max_words, processed) for sentence in sentences]
+
+        # Get PoS tags
+        # See: https://www.ling.upenn.edu/courses/Fall_2003/ling001/penn_treebank_pos.html
+        # Note: this is not very accurate for post titles with title case (You Will Never Believe)
+        if batch:
+            tagged = self.tagger.tag_sents(token_lists)
+        else:
+            tagged = [self.tagger.tag(tokens) for tokens in token_lists]
+
+        return [self.__from_tags(pos_raw, remove_digits, remove_stopwords) for pos_raw in tagged]
+
+    def __tokenize(self, sentence, max_words, processed):
         if not processed and not isinstance(sentence, str):
             raise ValueError("Word features can only be extracted from a single string.")
 
@@ -58,10 +86,10 @@ class WordTools:
         # tokens = [WordTools.convert_ner_case(token) for token in tokens if token[0]]
         # TODO: removed, NER tagging outside the Stanford NLP pipeline takes too long / much duplicate effort
 
-        # Get PoS tags
-        # See: https://www.ling.upenn.edu/courses/Fall_2003/ling001/penn_treebank_pos.html
-        # Note: this is not very accurate for post titles with title case (You Will Never Believe)
-        pos_raw = pos_tag(tokens)
+        return tokens
+
+    def __from_tags(self, pos_raw, remove_digits, remove_stopwords):
+        """Filters the PoS-tagged tokens of a sentence and splits them into words, formal words and stop words."""
 
         # Remove punctuation
         pos = self.__filter_tags(pos_raw, {'.', ':', ',', "''", '$', "``", "(", ")"})
@@ -74,15 +102,9 @@ class WordTools:
         pos, stopwords = self.__split_stopwords(pos, remove_stopwords)
 
         # Separate the words from the PoS-tag tuples
-        all_words, all_tags = self.__split_words_tags(pos)
-
-        # Generate 2- and 3-grams (words)
-        # word_2gram, word_3gram = self.__get_ngrams(all_words, 2, 3)
-        # TODO: removed, future work
+        all_words, _ = self.__split_words_tags(pos)
 
-        # Generate 2- and 3-grams (pos)
-        # pos_2gram, pos_3gram = self.__get_ngrams(all_tags, 2, 3)
-        # TODO: removed, re-enable once PoS tagging is more accurate
+        # Word and PoS n-grams are hashed from the returned PoS tuples (see NgramHasher)
 
         # Map PoS tags to WordNet tags, lemmatize and find lemmas in WordNet
         wn_pos = [self.__penn_to_wn(x) for x in pos]
@@ -171,13 +193,6 @@ class WordTools:
 
         return [word_tag for word_tag in list_of_tuples if word_tag[1] not in tags]
 
-    def __get_ngrams(self, words, n1, n2):
-
-        n1gram = list(ngrams(words, n1))
-        n2gram = list(ngrams(words, n2))
-
-        return n1gram, n2gram
-
     def __nltk_init(self):
         """Download and install NLTK resources if not found on the system."""
 